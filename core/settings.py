@@ -79,9 +79,54 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    },
+    # Extra SQLite files DynamicModel instances can be partitioned onto.
+    # Run `python manage.py migrate --database=<alias>` once for each of them.
+    'shard1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'shard1.sqlite3',
+    },
+    'shard2': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'shard2.sqlite3',
+    },
 }
 
+DATABASE_ROUTERS = ['dynamic_app.routers.DynamicModelRouter']
+
+# Aliases that may store DynamicModel instances, and where new models are placed
+DYNAMIC_MODEL_SHARDS = ['default', 'shard1', 'shard2']
+DYNAMIC_MODEL_DEFAULT_SHARD = 'default'
+# Seconds a process keeps its cached copy of the placement map; a move waits this long
+# before picking up writes that went to the old shard through a stale copy
+DYNAMIC_MODEL_PLACEMENT_TTL = 5
+# Instance and file ids each process reserves from the global sequence on default at a time
+DYNAMIC_MODEL_ID_BLOCK_SIZE = 100
+
+# Change log: seconds between polls for long-poll/SSE consumers, SSE connection
+# lifetime, and defaults for `manage.py compact_changelog`
+CHANGELOG_POLL_INTERVAL = 1
+CHANGELOG_STREAM_SECONDS = 300
+CHANGELOG_RETENTION_DAYS = 30
+CHANGELOG_COMPACT_AFTER_HOURS = 24
+
+# Instance history: a full snapshot every N versions, deltas in between, and
+# defaults for `manage.py prune_history`
+HISTORY_SNAPSHOT_INTERVAL = 10
+HISTORY_RETENTION_DAYS = 365
+HISTORY_KEEP_VERSIONS = 10
+
+# Text and file values whose JSON is larger than this many bytes are compressed
+# into an InstanceBlob; the instance keeps a reference with a short preview
+BLOB_OFFLOAD_THRESHOLD = 2048
+BLOB_PREVIEW_CHARS = 64
+
+# File downloads: None streams files from Django; 'x-accel-redirect' (nginx) or
+# 'x-sendfile' (Apache, lighttpd) hands the transfer to the web server.
+# nginx needs an internal location mapping DYNAMIC_FILES_SENDFILE_PREFIX to the media files.
+DYNAMIC_FILES_SENDFILE = None
+DYNAMIC_FILES_SENDFILE_PREFIX = '/protected-media/'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -24,6 +24,8 @@ urlpatterns = [
     path('', views.model_list, name='model_list'),
     path('model_create', views.model_create, name='model_create'),
     path('models/<int:pk>/', views.model_detail, name='model_detail'),
+    path('models/<int:model_pk>/schema/', views.model_schema, name='model_schema'),
+    path('models/schema/', views.schema_import, name='schema_import'),
     
     path('models/<int:model_pk>/fields/create/', views.field_create, name='field_create'),
     path('fields/<int:field_id>/choices/', views.add_field_choices, name='add_field_choices'),
@@ -32,7 +34,14 @@ urlpatterns = [
     path('models/<int:model_pk>/instances/', views.instance_list, name='instance_list'),
     path('models/<int:model_pk>/instances/create/', views.instance_create, name='instance_create'),
     path('instances/<int:instance_id>/fields/<int:field_id>/upload/', views.upload_file, name='upload_file'),
+    path('files/<int:file_id>/download/', views.file_download, name='file_download'),
+    path('instances/<int:instance_id>/history/', views.instance_history, name='instance_history'),
+    path('models/<int:model_pk>/history/', views.model_history, name='model_history'),
+    path('models/<int:model_pk>/history/stats/', views.model_history_stats, name='model_history_stats'),
     
     path('search/', views.dynamic_instance_search, name='dynamic_instance_search'),
+    
+    path('changes/', views.change_feed, name='change_feed'),
+    path('changes/stream/', views.change_stream, name='change_stream'),
 
 ]
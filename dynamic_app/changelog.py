@@ -0,0 +1,301 @@
+"""
+Change-data-capture log for instances, fields and files.
+
+Every change is stored as a compact diff of the form
+``{"set": {name: new_value, ...}, "unset": [name, ...]}`` with empty parts left out.
+"""
+import heapq
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from .partitioning import shard_aliases
+
+FIELD_ATTRIBUTES = [
+    'name', 'display_name', 'field_type', 'is_required', 'is_unique', 'is_readonly', 'display_order',
+    'expression', 'persist_result',
+]
+
+_suppressed = ContextVar('changelog_suppressed', default=False)
+
+
+class CursorExpired(Exception):
+    """Retention deleted changes a cursor had not read yet; the consumer has to resync."""
+
+
+@contextmanager
+def suppressed():
+    """Skip logging for internal data movement, e.g. rows moved between shards."""
+    token = _suppressed.set(True)
+    try:
+        yield
+    finally:
+        _suppressed.reset(token)
+
+
+def is_suppressed():
+    return _suppressed.get()
+
+
+def diff_data(old, new):
+    """Field-level diff turning ``old`` into ``new``."""
+    changes = {}
+    changed = {key: value for key, value in new.items() if key not in old or old[key] != value}
+    removed = [key for key in old if key not in new]
+    if changed:
+        changes['set'] = changed
+    if removed:
+        changes['unset'] = removed
+    return changes
+
+
+def apply_changes(data, changes):
+    """Return a copy of ``data`` with a diff from ``diff_data`` applied."""
+    data = dict(data)
+    for key in changes.get('unset', []):
+        data.pop(key, None)
+    data.update(changes.get('set', {}))
+    return data
+
+
+def merge_changes(first, second):
+    """Combine two consecutive diffs into one equivalent diff."""
+    set_values = dict(first.get('set', {}))
+    unset = list(first.get('unset', []))
+    for key in second.get('unset', []):
+        set_values.pop(key, None)
+        if key not in unset:
+            unset.append(key)
+    for key, value in second.get('set', {}).items():
+        set_values[key] = value
+        if key in unset:
+            unset.remove(key)
+    merged = {}
+    if set_values:
+        merged['set'] = set_values
+    if unset:
+        merged['unset'] = unset
+    return merged
+
+
+def object_type_of(obj):
+    return {
+        'DynamicModelInstance': 'instance',
+        'DynamicField': 'field',
+        'DynamicFieldFile': 'file',
+    }[type(obj).__name__]
+
+
+def snapshot(obj):
+    """The logged state of an instance, field or file as a flat dict."""
+    object_type = object_type_of(obj)
+    if object_type == 'instance':
+        return dict(obj.data or {})
+    if object_type == 'field':
+        return {name: getattr(obj, name) for name in FIELD_ATTRIBUTES}
+    return {
+        'field': obj.field_id,
+        'file': obj.file.name if obj.file else None,
+        'file_name': obj.file_name,
+        'file_extension': obj.file_extension,
+    }
+
+
+def dynamic_model_id_of(obj):
+    if object_type_of(obj) == 'file':
+        return obj.instance.dynamic_model_id
+    return obj.dynamic_model_id
+
+
+def record(obj, action, using, old=None):
+    """Append a ChangeLogEntry for ``obj`` on ``using``; ``old`` is the state before an update."""
+    from .models import ChangeLogEntry
+
+    if _suppressed.get():
+        return None
+    if action == 'delete':
+        changes = {}
+    else:
+        changes = diff_data(old or {}, snapshot(obj))
+        if action == 'update' and not changes:
+            return None
+    return ChangeLogEntry.objects.using(using).create(
+        dynamic_model_id=dynamic_model_id_of(obj),
+        object_type=object_type_of(obj),
+        object_id=obj.pk,
+        action=action,
+        changes=changes,
+    )
+
+
+def record_bulk_create(objs, using):
+    """Log rows inserted with ``bulk_create``, which sends no signals."""
+    from .models import ChangeLogEntry
+
+    if _suppressed.get() or not objs:
+        return []
+    return ChangeLogEntry.objects.using(using).bulk_create([
+        ChangeLogEntry(
+            dynamic_model_id=dynamic_model_id_of(obj),
+            object_type=object_type_of(obj),
+            object_id=obj.pk,
+            action='create',
+            changes=diff_data({}, snapshot(obj)),
+        )
+        for obj in objs
+    ])
+
+
+def record_bulk_update(changed, using):
+    """Log ``(obj, previous_snapshot)`` pairs written with ``bulk_update``, which sends no signals."""
+    from .models import ChangeLogEntry
+
+    if _suppressed.get() or not changed:
+        return []
+    return ChangeLogEntry.objects.using(using).bulk_create([
+        ChangeLogEntry(
+            dynamic_model_id=dynamic_model_id_of(obj),
+            object_type=object_type_of(obj),
+            object_id=obj.pk,
+            action='update',
+            changes=diff_data(previous, snapshot(obj)),
+        )
+        for obj, previous in changed
+    ])
+
+
+def parse_cursor(cursor):
+    """``"default:12,shard1:40"`` -> ``{'default': 12, 'shard1': 40}``."""
+    positions = {}
+    for part in filter(None, (cursor or '').split(',')):
+        alias, _, position = part.partition(':')
+        if alias not in shard_aliases() or not position.isdigit():
+            raise ValueError(f"Invalid cursor segment '{part}'.")
+        positions[alias] = int(position)
+    return positions
+
+
+def format_cursor(positions):
+    return ','.join(f"{alias}:{positions[alias]}" for alias in shard_aliases() if alias in positions)
+
+
+def serialize(entry, alias):
+    return {
+        'id': entry.pk,
+        'shard': alias,
+        'model': entry.dynamic_model_id,
+        'object': entry.object_type,
+        'object_id': entry.object_id,
+        'action': entry.action,
+        'changes': entry.changes,
+        'at': entry.created_at.isoformat(),
+    }
+
+
+def changes_since(cursor, dynamic_model_ids, limit=100):
+    """
+    Return ``(entries, next_cursor)`` for changes after ``cursor`` on models in ``dynamic_model_ids``.
+
+    Each shard is read in id order and the shards are merged by timestamp, so
+    every shard's position in the returned cursor only moves past entries that
+    were actually returned. Raises CursorExpired when retention has already
+    deleted changes of these models after the cursor's position on some shard.
+    """
+    from .models import ChangeLogEntry, ChangeLogHorizon
+
+    positions = parse_cursor(cursor)
+    streams = []
+    for alias in shard_aliases():
+        position = positions.get(alias, 0)
+        if cursor and ChangeLogHorizon.objects.using(alias).filter(
+            dynamic_model_id__in=dynamic_model_ids, expired_through__gt=position,
+        ).exists():
+            raise CursorExpired(
+                f"Changes after '{alias}:{position}' are past retention. Resync, then read from since=latest."
+            )
+        entries = ChangeLogEntry.objects.using(alias).filter(
+            pk__gt=position,
+            dynamic_model_id__in=dynamic_model_ids,
+        ).order_by('pk')[:limit]
+        streams.append([(entry.created_at, alias, entry) for entry in entries])
+
+    results = []
+    for created_at, alias, entry in heapq.merge(*streams, key=lambda item: item[0]):
+        if len(results) == limit:
+            break
+        results.append(serialize(entry, alias))
+        positions[alias] = entry.pk
+    return results, format_cursor(positions)
+
+
+def latest_cursor():
+    """A cursor positioned after every change logged so far."""
+    from django.db.models import Max
+    from .models import ChangeLogEntry, ChangeLogHorizon
+
+    positions = {}
+    for alias in shard_aliases():
+        last = ChangeLogEntry.objects.using(alias).order_by('-pk').values_list('pk', flat=True).first()
+        # Retention may have emptied the log, but the cursor must still be past what it deleted
+        expired = ChangeLogHorizon.objects.using(alias).aggregate(last=Max('expired_through'))['last']
+        positions[alias] = max(last or 0, expired or 0)
+    return format_cursor(positions)
+
+
+def expire(alias, before):
+    """
+    Delete the entries created before ``before`` on ``alias``, recording per
+    DynamicModel the highest id deleted so cursors still behind it are refused
+    instead of silently skipping changes. Returns the number of entries deleted.
+    """
+    from django.db import transaction
+    from django.db.models import Max
+    from .models import ChangeLogEntry, ChangeLogHorizon
+
+    with transaction.atomic(using=alias):
+        expired = ChangeLogEntry.objects.using(alias).filter(created_at__lt=before)
+        horizons = dict(expired.values('dynamic_model_id').annotate(last=Max('id')).values_list(
+            'dynamic_model_id', 'last'
+        ))
+        stored = dict(ChangeLogHorizon.objects.using(alias).filter(
+            dynamic_model_id__in=horizons
+        ).values_list('dynamic_model_id', 'expired_through'))
+        ChangeLogHorizon.objects.using(alias).bulk_create(
+            [
+                ChangeLogHorizon(dynamic_model_id=model_id, expired_through=max(last, stored.get(model_id, 0)))
+                for model_id, last in horizons.items()
+            ],
+            update_conflicts=True, unique_fields=['dynamic_model_id'], update_fields=['expired_through', 'updated_at'],
+        )
+        deleted, _ = expired.delete()
+    return deleted
+
+
+def compact(alias, before):
+    """
+    Collapse each object's entries older than ``before`` on ``alias`` into one.
+
+    The merged entry keeps the id of the object's last entry, so a consumer whose
+    cursor sits anywhere before it still receives the object's final state.
+    Returns the number of entries removed.
+    """
+    from django.db import transaction
+    from django.db.models import Count
+    from .models import ChangeLogEntry
+
+    old_entries = ChangeLogEntry.objects.using(alias).filter(created_at__lt=before)
+    repeated = list(old_entries.values('object_type', 'object_id').annotate(n=Count('id')).filter(n__gt=1))
+    removed = 0
+    for group in repeated:
+        with transaction.atomic(using=alias):
+            entries = list(old_entries.filter(object_type=group['object_type'], object_id=group['object_id']))
+            last = entries[-1]
+            if last.action != 'delete':
+                changes = {}
+                for entry in entries:
+                    changes = merge_changes(changes, entry.changes)
+                last.changes = changes
+                last.action = 'create' if entries[0].action == 'create' else 'update'
+                last.save(using=alias, update_fields=['action', 'changes'])
+            ChangeLogEntry.objects.using(alias).filter(pk__in=[entry.pk for entry in entries[:-1]]).delete()
+            removed += len(entries) - 1
+    return removed
@@ -0,0 +1,377 @@
+"""
+Computed fields: values derived from an instance's other fields.
+
+An expression uses a small, safe subset of Python syntax, e.g. ``price * qty``,
+``concat(first, " ", last)`` or ``round(total / count, 2) if count else 0``.
+Expressions are parsed once into a tree of column operations and cached, and
+always evaluate over a batch of rows at a time: each node produces the list of
+its values for the whole batch. A row that fails (bad input, division by zero,
+a missing value) gets ``None`` instead of failing the batch.
+"""
+import ast
+import math
+import operator
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+
+from django.core.exceptions import ValidationError
+
+MAX_EXPONENT = 100
+# Nested powers stay within the exponent limit but still grow without bound, so cap the result too
+MAX_POWER_DIGITS = 1000
+
+
+def _power(base, exponent):
+    if abs(exponent) > MAX_EXPONENT:
+        raise ValueError("Exponent too large.")
+    if base and float(exponent) * math.log10(abs(base)) > MAX_POWER_DIGITS:
+        raise ValueError("Result too large.")
+    return base ** exponent
+
+
+def _multiply(a, b):
+    if isinstance(a, str) or isinstance(b, str):
+        raise TypeError("Strings cannot be multiplied.")
+    return a * b
+
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: _multiply,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: _power,
+}
+COMPARISONS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+
+def _present(values):
+    return [value for value in values if value is not None]
+
+
+FUNCTIONS = {
+    'concat': lambda *args: ''.join('' if arg is None else str(arg) for arg in args),
+    'upper': lambda value: str(value).upper(),
+    'lower': lambda value: str(value).lower(),
+    'len': lambda value: len(str(value)),
+    'abs': abs,
+    'round': lambda value, digits=0: round(value, int(digits)),
+    'min': lambda *args: min(_present(args)),
+    'max': lambda *args: max(_present(args)),
+    'coalesce': lambda *args: next(iter(_present(args)), None),
+}
+# Functions that handle None themselves; everything else propagates None
+NULL_AWARE_FUNCTIONS = {'concat', 'min', 'max', 'coalesce'}
+
+
+def _to_bool(value):
+    return value in (True, 'true', 'True', 'on', '1', 1)
+
+
+COERCIONS = {
+    'int': int,
+    'decimal': Decimal,
+    'bool': _to_bool,
+}
+
+
+def _coerce(field_type):
+    convert = COERCIONS.get(field_type, lambda value: value)
+
+    def coerce(value):
+        if value is None or value == '':
+            return None
+        try:
+            return convert(value)
+        except (TypeError, ValueError, InvalidOperation):
+            return None
+    return coerce
+
+
+def _call(function, args, null_aware=False):
+    if not null_aware and any(arg is None for arg in args):
+        return None
+    try:
+        return function(*args)
+    except (TypeError, ValueError, ArithmeticError, InvalidOperation):
+        return None
+
+
+def _constant(value, rows):
+    return [value] * len(rows)
+
+
+def _compile(node, field_types, inputs):
+    """Turn an AST node into a function from a batch of rows to a list of values."""
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float, str, bool, type(None))):
+        value = Decimal(repr(node.value)) if isinstance(node.value, float) else node.value
+        return lambda rows: _constant(value, rows)
+
+    if isinstance(node, ast.Name):
+        if node.id not in field_types:
+            raise ValidationError(f"Unknown field '{node.id}' in expression.")
+        inputs.add(node.id)
+        name, coerce = node.id, _coerce(field_types[node.id])
+        return lambda rows: [coerce(row.get(name)) for row in rows]
+
+    if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+        op = BINARY_OPERATORS[type(node.op)]
+        left, right = _compile(node.left, field_types, inputs), _compile(node.right, field_types, inputs)
+        return lambda rows: [_call(op, pair) for pair in zip(left(rows), right(rows))]
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd, ast.Not)):
+        operand = _compile(node.operand, field_types, inputs)
+        if isinstance(node.op, ast.Not):
+            return lambda rows: [not value for value in operand(rows)]
+        op = operator.neg if isinstance(node.op, ast.USub) else operator.pos
+        return lambda rows: [_call(op, (value,)) for value in operand(rows)]
+
+    if isinstance(node, ast.BoolOp):
+        operands = [_compile(value, field_types, inputs) for value in node.values]
+        combine = all if isinstance(node.op, ast.And) else any
+        return lambda rows: [combine(values) for values in zip(*(operand(rows) for operand in operands))]
+
+    if isinstance(node, ast.Compare) and all(type(op) in COMPARISONS for op in node.ops):
+        operands = [_compile(node.left, field_types, inputs)] + [
+            _compile(comparator, field_types, inputs) for comparator in node.comparators
+        ]
+        ops = [COMPARISONS[type(op)] for op in node.ops]
+
+        def compare(rows):
+            columns = [operand(rows) for operand in operands]
+            return [
+                all(_call(op, (values[i], values[i + 1])) for i, op in enumerate(ops))
+                for values in zip(*columns)
+            ]
+        return compare
+
+    if isinstance(node, ast.IfExp):
+        test = _compile(node.test, field_types, inputs)
+        body = _compile(node.body, field_types, inputs)
+        orelse = _compile(node.orelse, field_types, inputs)
+        return lambda rows: [
+            yes if condition else no for condition, yes, no in zip(test(rows), body(rows), orelse(rows))
+        ]
+
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS
+            and not node.keywords):
+        function, null_aware = FUNCTIONS[node.func.id], node.func.id in NULL_AWARE_FUNCTIONS
+        args = [_compile(arg, field_types, inputs) for arg in node.args]
+        if not args:
+            raise ValidationError(f"{node.func.id}() needs at least one argument.")
+        return lambda rows: [_call(function, values, null_aware) for values in zip(*(arg(rows) for arg in args))]
+
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id not in FUNCTIONS:
+        raise ValidationError(
+            f"Unknown function '{node.func.id}'. Available functions: {', '.join(sorted(FUNCTIONS))}."
+        )
+    raise ValidationError(f"Unsupported expression syntax: {ast.unparse(node)}")
+
+
+class CompiledExpression:
+    def __init__(self, evaluate, inputs):
+        self.evaluate = evaluate
+        self.inputs = frozenset(inputs)
+
+
+@lru_cache(maxsize=512)
+def compile_expression(expression, field_types):
+    """
+    Parse ``expression`` once for a given set of ``(name, field_type)`` pairs.
+    The cache key changes whenever the model's fields change.
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValidationError(f"Invalid expression: {e.msg}.")
+    inputs = set()
+    evaluate = _compile(tree.body, dict(field_types), inputs)
+    return CompiledExpression(evaluate, inputs)
+
+
+def _to_json(value):
+    if isinstance(value, Decimal):
+        return str(value) if value.is_finite() else None
+    if isinstance(value, float):
+        return value if value == value and abs(value) != float('inf') else None
+    return value
+
+
+def computed_fields(fields):
+    """
+    ``[(field, compiled), ...]`` for the computed fields among ``fields``, ordered so
+    that a computed field comes after every computed field it reads.
+    """
+    fields = list(fields)
+    field_types = tuple(sorted((field.name, field.field_type) for field in fields))
+    pending = {}
+    for field in fields:
+        if field.field_type == 'computed':
+            if not field.expression:
+                raise ValidationError(f"Computed field '{field.name}' needs an expression.")
+            pending[field.name] = (field, compile_expression(field.expression, field_types))
+
+    ordered = []
+    while pending:
+        ready = [name for name, (field, compiled) in pending.items() if not compiled.inputs & pending.keys()]
+        if not ready:
+            raise ValidationError(f"Computed fields depend on each other in a cycle: {', '.join(pending)}.")
+        for name in ready:
+            ordered.append(pending.pop(name))
+    return ordered
+
+
+def formula_errors(fields):
+    """``{name: message}`` for the computed fields among ``fields`` whose expression does not compile."""
+    fields = list(fields)
+    field_types = tuple(sorted((field.name, field.field_type) for field in fields))
+    errors = {}
+    for field in fields:
+        if field.field_type != 'computed':
+            continue
+        if not field.expression:
+            errors[field.name] = f"Computed field '{field.name}' needs an expression."
+            continue
+        try:
+            compile_expression(field.expression, field_types)
+        except ValidationError as e:
+            errors[field.name] = e.messages[0]
+    return errors
+
+
+def _usable(fields):
+    """
+    ``(computed_fields(), broken names)`` for a schema that may already be broken,
+    e.g. by renaming a field a formula reads. Broken formulas, and any that read
+    them, are left out instead of failing every evaluation.
+    """
+    fields = list(fields)
+    broken = set()
+    while True:
+        try:
+            return computed_fields(fields), broken
+        except ValidationError:
+            errors = formula_errors(fields)
+            if not errors:
+                # A cycle: none of the computed fields can be ordered
+                return [], broken | {field.name for field in fields if field.field_type == 'computed'}
+            broken |= errors.keys()
+            fields = [field for field in fields if field.name not in errors]
+
+
+def evaluate(fields, rows, only=None):
+    """
+    Computed values for a batch of ``data`` dicts, as one dict per row.
+    ``only`` limits the result to those computed field names. Fields whose
+    formula no longer works come out as None.
+    """
+    ordered, broken = _usable(fields)
+    broken = {name for name in broken if only is None or name in only}
+    results = [dict.fromkeys(broken) for _ in rows]
+    working = [dict(row) for row in rows]
+    for field, compiled in ordered:
+        values = compiled.evaluate(working)
+        for row, result, value in zip(working, results, values):
+            row[field.name] = value
+            if only is None or field.name in only:
+                result[field.name] = _to_json(value)
+    return results
+
+
+def affected_by(fields, changed):
+    """Names of the computed fields whose inputs, directly or through other computed fields, changed."""
+    ordered, broken = _usable(fields)
+    affected = set(broken)
+    for field, compiled in ordered:
+        if compiled.inputs & (set(changed) | affected):
+            affected.add(field.name)
+    return affected
+
+
+def refresh_persisted(fields, rows, changed=None):
+    """
+    Write persisted computed values into each ``data`` dict in ``rows``.
+    With ``changed`` (names of modified fields) only the affected fields are recomputed.
+    Returns the names of the fields that were recomputed.
+    """
+    persisted = {field.name for field in fields if field.field_type == 'computed' and field.persist_result}
+    if changed is not None:
+        persisted &= affected_by(fields, changed)
+    if not persisted:
+        return set()
+    for row, values in zip(rows, evaluate(fields, rows, only=persisted)):
+        row.update(values)
+    return persisted
+
+
+def refresh_instances(fields, instances, using, changed=None):
+    """
+    ``refresh_persisted`` for DynamicModelInstances read from ``using``. Offloaded
+    values are resolved first so expressions see the real text; only the
+    recomputed values are written back into each instance's ``data``.
+    """
+    from .offload import resolve
+
+    instances = list(instances)
+    rows = resolve({instance.pk: instance.data for instance in instances}, using)
+    recomputed = refresh_persisted(fields, [rows[instance.pk] for instance in instances], changed)
+    for instance in instances:
+        for name in recomputed:
+            instance.data[name] = rows[instance.pk][name]
+    return recomputed
+
+
+def recompute(model, batch_size=1000):
+    """
+    Refresh the persisted computed values of every instance of ``model``, in
+    batches, logging changed rows and their history like a save would.
+    Returns ``(scanned, changed)``.
+    """
+    from django.db import transaction
+    from . import changelog, history
+    from .models import DynamicModelInstance
+    from .partitioning import instances_for, shard_for
+
+    fields = list(model.fields.all())
+    if not any(field.field_type == 'computed' and field.persist_result for field in fields):
+        return 0, 0
+
+    alias = shard_for(model)
+    scanned = updated = last_pk = 0
+    while True:
+        batch = list(instances_for(model).filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+        if not batch:
+            break
+        previous = [changelog.snapshot(instance) for instance in batch]
+        refresh_instances(fields, batch, alias)
+        changed = [(instance, old) for instance, old in zip(batch, previous) if instance.data != old]
+        with transaction.atomic(using=alias):
+            DynamicModelInstance.objects.using(alias).bulk_update([instance for instance, _ in changed], ['data'])
+            changelog.record_bulk_update(changed, alias)
+            # bulk_update sends no post_save, so the history has to be kept in step here
+            for instance, old in changed:
+                history.record_version(instance, alias, previous=old)
+        scanned += len(batch)
+        updated += len(changed)
+        last_pk = batch[-1].pk
+    return scanned, updated
+
+
+def with_display_values(fields, instances):
+    """Fill in computed fields that are not persisted, in one batch, for display only."""
+    transient = {field.name for field in fields if field.field_type == 'computed' and not field.persist_result}
+    if not transient:
+        return instances
+    instances = list(instances)
+    for instance, values in zip(instances, evaluate(fields, [instance.data for instance in instances], only=transient)):
+        instance.data = {**instance.data, **values}
+    return instances
@@ -0,0 +1,162 @@
+"""
+Pre-flight checks for turning on ``is_required`` or ``is_unique`` on a field
+that already has data.
+
+Each check is a single set-based query over the model's instances on its
+shard: a scan for null or blank values, and a GROUP BY on the field's value
+with HAVING COUNT > 1. Offloaded values are stored as a reference holding the
+content digest, so equal values still group together.
+"""
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, TextField
+from django.db.models.fields.json import KeyTextTransform
+from django.db.models.functions import Cast
+
+from . import changelog, computed, history, offload
+from .models import DynamicModelInstance, InstanceBlob
+from .partitioning import instances_for, shard_for
+
+# How many example instances and duplicate values a report lists
+SAMPLE_SIZE = 20
+REQUIRED_EXEMPT_TYPES = ('computed',)
+UNIQUE_EXEMPT_TYPES = ('file',)
+# Field types a typed-in fill value cannot stand for
+UNFILLABLE_TYPES = ('file', 'computed')
+BOOLEAN_VALUES = ('true', 'false', 'True', 'False', 'on', 'off', '1', '0')
+PARSERS = {
+    'int': int,
+    'decimal': Decimal,
+    'date': date.fromisoformat,
+    'datetime': datetime.fromisoformat,
+}
+
+
+def _values(model, name):
+    # Cast to plain text so lookups compare SQL values instead of going through JSON key lookups
+    return instances_for(model).annotate(value=Cast(KeyTextTransform(name, 'data'), TextField()))
+
+
+def _missing(model, name):
+    return _values(model, name).filter(Q(value__isnull=True) | Q(value=''))
+
+
+def _present(model, name):
+    return _values(model, name).exclude(value__isnull=True).exclude(value='')
+
+
+def check(model, name, field_type, required=False, unique=False):
+    """
+    Instances of ``model`` that would break the new constraints on field ``name``.
+
+    Returns ``{}`` when the data already complies, otherwise ``missing`` and/or
+    ``duplicates`` with totals and up to SAMPLE_SIZE examples each.
+    """
+    report = {}
+    if required and field_type not in REQUIRED_EXEMPT_TYPES:
+        missing = _missing(model, name)
+        count = missing.count()
+        if count:
+            report['missing'] = {
+                'count': count,
+                'instances': list(missing.order_by('pk').values_list('pk', flat=True)[:SAMPLE_SIZE]),
+            }
+
+    if unique and field_type not in UNIQUE_EXEMPT_TYPES:
+        groups = extra = 0
+        examples = []
+        duplicates = _present(model, name).values('value').annotate(count=Count('pk')).filter(count__gt=1)
+        for row in duplicates.order_by('-count', 'value').iterator():
+            groups += 1
+            extra += row['count'] - 1
+            if len(examples) < SAMPLE_SIZE:
+                examples.append({'value': row['value'], 'count': row['count'], 'instances': []})
+        if groups:
+            by_value = {example['value']: example for example in examples}
+            for value, pk in _values(model, name).filter(value__in=list(by_value)).order_by('pk').values_list('value', 'pk'):
+                if len(by_value[value]['instances']) < SAMPLE_SIZE:
+                    by_value[value]['instances'].append(pk)
+            report['duplicates'] = {'groups': groups, 'count': extra, 'examples': examples}
+    return report
+
+
+def clean_value(field, value):
+    """Raise ValidationError unless ``value``, as typed into a form, is valid for ``field``."""
+    if field.field_type in UNFILLABLE_TYPES:
+        raise ValidationError(f"{field.get_field_type_display()} fields cannot be filled with a value.")
+    if field.field_type == 'bool' and value not in BOOLEAN_VALUES:
+        raise ValidationError(f"'{value}' is not a boolean. Use one of: {', '.join(BOOLEAN_VALUES)}.")
+    if field.field_type in PARSERS:
+        try:
+            PARSERS[field.field_type](value)
+        except (ValueError, InvalidOperation):
+            raise ValidationError(f"'{value}' is not a valid {field.get_field_type_display().lower()}.")
+    if field.field_type == 'choice':
+        valid_choices = list(field.choices.values_list('value', flat=True))
+        if value not in valid_choices:
+            raise ValidationError(f"Invalid choice: {value}. Valid choices are: {', '.join(valid_choices)}.")
+
+
+def fill_missing(model, name, value, batch_size=1000):
+    """
+    Set ``value`` on every instance where field ``name`` is null or blank.
+    The value is checked with ``clean_value`` first. Returns the number filled.
+    """
+    alias = shard_for(model)
+    fields = list(model.fields.all())
+    clean_value(next(field for field in fields if field.name == name), value)
+    pks = list(_missing(model, name).order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(pks), batch_size):
+        batch = list(instances_for(model).filter(pk__in=pks[start:start + batch_size]))
+        previous = [changelog.snapshot(instance) for instance in batch]
+        for instance in batch:
+            instance.data[name] = value
+        computed.refresh_instances(fields, batch, alias, {name})
+        # bulk_update sends no pre_save or post_save, so offloading, the change log
+        # and the history all have to be kept in step here
+        pending = [offload.extract(instance, fields) for instance in batch]
+        with transaction.atomic(using=alias):
+            DynamicModelInstance.objects.using(alias).bulk_update(batch, ['data'])
+            InstanceBlob.objects.using(alias).bulk_create([
+                blob for instance, blobs in zip(batch, pending) for blob in offload.blobs_for(instance, blobs, alias)
+            ])
+            changelog.record_bulk_update(list(zip(batch, previous)), alias)
+            for instance, old in zip(batch, previous):
+                history.record_version(instance, alias, previous=old)
+    return len(pks)
+
+
+def drop_duplicates(model, name):
+    """
+    Delete every instance that repeats the value of field ``name`` from an
+    older instance, keeping the oldest one per value. Returns the number deleted.
+    """
+    # Processes hand out ids from their own blocks, so age comes from created_at, with the id breaking ties
+    oldest = _present(model, name).filter(value=OuterRef('value')).order_by('created_at', 'pk').values('pk')[:1]
+    newer = DynamicModelInstance.objects.using(shard_for(model)).filter(
+        pk__in=_present(model, name).annotate(oldest=Subquery(oldest)).exclude(pk=F('oldest')).values('pk')
+    )
+    deleted, _ = newer.delete()
+    return deleted
+
+
+def apply_fixes(model, name, field_type, required=False, unique=False, fill_value=None, drop=False):
+    """
+    Fill missing values with ``fill_value`` and/or ``drop`` duplicates, then
+    ``check()`` again. It all runs in one transaction on the model's shard,
+    rolled back unless no conflicts remain, so a refused field change leaves
+    the data as it was. Returns the report of the remaining conflicts.
+    """
+    alias = shard_for(model)
+    with transaction.atomic(using=alias):
+        if required and fill_value:
+            fill_missing(model, name, fill_value)
+        if unique and drop:
+            drop_duplicates(model, name)
+        report = check(model, name, field_type, required, unique)
+        if report:
+            transaction.set_rollback(True, using=alias)
+    return report
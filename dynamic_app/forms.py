@@ -24,27 +24,42 @@ class DynamicFieldForm(forms.ModelForm):
         model = DynamicField
         fields = [
             'dynamic_model', 'name', 'display_name', 'field_type',
-            'is_required', 'is_unique', 'is_readonly', 'display_order'
+            'is_required', 'is_unique', 'is_readonly', 'display_order',
+            'expression', 'persist_result'
         ]
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, dynamic_model=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.fields['dynamic_model'].queryset = DynamicModel.objects.all()
+        if dynamic_model is not None:
+            self.instance.dynamic_model = dynamic_model
+        if self.instance.dynamic_model_id:
+            # The model is already known from the URL, so skip the dropdown of every DynamicModel
+            del self.fields['dynamic_model']
+        else:
+            self.fields['dynamic_model'].queryset = DynamicModel.objects.all()
 
     def clean(self):
         cleaned_data = super().clean()
         field_type = cleaned_data.get('field_type')
         is_unique = cleaned_data.get('is_unique')
+        name = cleaned_data.get('name')
 
         if field_type == 'file' and is_unique:
             raise ValidationError("File fields cannot be marked as unique.")
 
+        # unique_together is not checked by the form once 'dynamic_model' is not one of its fields
+        if name and self.instance.dynamic_model_id and DynamicField.objects.filter(
+            dynamic_model_id=self.instance.dynamic_model_id, name=name
+        ).exclude(pk=self.instance.pk).exists():
+            self.add_error('name', "A field with this name already exists on this model.")
+
         return cleaned_data
 
     def save(self, commit=True):
         field = super().save(commit=False)
         if commit:
-            field.created_by = self.initial.get('created_by')
+            if not field.created_by_id:
+                field.created_by = self.initial.get('created_by')
             field.save()
         return field
 
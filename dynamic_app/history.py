@@ -0,0 +1,169 @@
+"""
+Version history of DynamicModelInstance data.
+
+Every ``HISTORY_SNAPSHOT_INTERVAL`` versions an instance gets a full snapshot;
+the versions in between store the ``changelog.diff_data`` diff against the
+version before them. Reading a version replays at most one snapshot interval.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Avg, Count, F, Max, Min, OuterRef, Q, Subquery, Sum, TextField
+from django.db.models.functions import Cast, Length
+
+from .changelog import apply_changes, diff_data
+from .offload import collect_garbage
+from .partitioning import shard_aliases, shard_for
+
+
+def _replay(rows, data=None):
+    for row in rows:
+        if row.is_deleted:
+            data = None
+        elif row.is_snapshot:
+            data = dict(row.payload)
+        else:
+            data = apply_changes(data or {}, row.payload)
+    return data
+
+
+def record_version(instance, using, previous=None, deleted=False):
+    """Append the instance's current state (or its deletion) as a new version."""
+    from .models import InstanceVersion
+
+    latest = InstanceVersion.objects.using(using).filter(instance_id=instance.pk).order_by('-version').first()
+    if deleted and latest is None:
+        return None
+
+    version = InstanceVersion(
+        instance_id=instance.pk,
+        dynamic_model_id=instance.dynamic_model_id,
+        version=latest.version + 1 if latest else 1,
+    )
+    if deleted:
+        version.is_deleted = True
+        version.base_version = latest.base_version
+    elif latest is None or latest.is_deleted or version.version - latest.base_version >= settings.HISTORY_SNAPSHOT_INTERVAL:
+        version.is_snapshot = True
+        version.base_version = version.version
+        version.payload = dict(instance.data or {})
+    else:
+        if previous is None:
+            previous = reconstruct(instance.pk, latest.version, using)
+        version.payload = diff_data(previous or {}, instance.data or {})
+        if not version.payload:
+            return None
+        version.base_version = latest.base_version
+    version.save(using=using)
+    return version
+
+
+def history_alias(instance_id):
+    """The shard holding an instance's versions, which outlive the instance itself."""
+    from .models import InstanceVersion
+
+    for alias in shard_aliases():
+        if InstanceVersion.objects.using(alias).filter(instance_id=instance_id).exists():
+            return alias
+    return None
+
+
+def reconstruct(instance_id, version=None, using=None):
+    """Data of ``instance_id`` at ``version`` (latest if omitted); ``None`` if deleted or unknown."""
+    from .models import InstanceVersion
+
+    using = using or history_alias(instance_id)
+    if using is None:
+        return None
+    rows = InstanceVersion.objects.using(using).filter(instance_id=instance_id)
+    target = rows.filter(version=version).first() if version else rows.order_by('-version').first()
+    if target is None:
+        return None
+    return _replay(rows.filter(version__range=(target.base_version, target.version)).order_by('version'))
+
+
+def state_as_of(dynamic_model, as_of):
+    """
+    ``{instance_id: data}`` for every instance of ``dynamic_model`` alive at ``as_of``.
+
+    One query fetches, per instance, the versions since its latest snapshot
+    taken at or before ``as_of``; the chains are then replayed in order.
+    """
+    from .models import InstanceVersion
+
+    versions = InstanceVersion.objects.using(shard_for(dynamic_model)).filter(
+        dynamic_model_id=dynamic_model.pk, created_at__lte=as_of
+    )
+    latest_snapshot = versions.filter(
+        instance_id=OuterRef('instance_id'), is_snapshot=True
+    ).order_by('-version').values('version')[:1]
+    rows = versions.annotate(base=Subquery(latest_snapshot)).filter(
+        version__gte=F('base')
+    ).order_by('instance_id', 'version')
+
+    state = {}
+    for row in rows.iterator():
+        state[row.instance_id] = _replay([row], state.get(row.instance_id))
+    return {instance_id: data for instance_id, data in state.items() if data is not None}
+
+
+def prune(using, before, keep_versions):
+    """
+    Drop versions created before ``before``, always keeping each instance's last
+    ``keep_versions`` versions. The oldest kept version is rewritten as a snapshot
+    so the remaining chain stays readable, and offloaded values nothing refers to
+    any more are deleted. Returns the number of versions removed.
+    """
+    from .models import InstanceVersion
+
+    versions = InstanceVersion.objects.using(using)
+    candidates = versions.values('instance_id').annotate(
+        count=Count('id'), first=Min('version'), latest=Max('version'), oldest=Min('created_at')
+    ).filter(count__gt=keep_versions, oldest__lt=before)
+
+    removed = 0
+    for candidate in list(candidates):
+        instance_versions = versions.filter(instance_id=candidate['instance_id'])
+        first_recent = instance_versions.filter(created_at__gte=before).order_by('version').values_list(
+            'version', flat=True
+        ).first()
+        cut = min(first_recent or candidate['latest'] + 1, candidate['latest'] - keep_versions + 1)
+        if cut <= candidate['first']:
+            continue
+        with transaction.atomic(using=using):
+            kept = instance_versions.get(version=cut)
+            if not kept.is_snapshot and not kept.is_deleted:
+                kept.payload = reconstruct(candidate['instance_id'], cut, using)
+                kept.is_snapshot = True
+                kept.base_version = cut
+                kept.save(using=using, update_fields=['payload', 'is_snapshot', 'base_version'])
+                instance_versions.filter(version__gt=cut, base_version__lt=cut).update(base_version=cut)
+            deleted, _ = instance_versions.filter(version__lt=cut).delete()
+            # Blobs only the dropped versions referred to are no longer reachable
+            collect_garbage(candidate['instance_id'], using)
+        removed += deleted
+    return removed
+
+
+def stats(dynamic_model):
+    """Storage and read-cost figures for a DynamicModel's history."""
+    from .models import InstanceVersion
+
+    size = Length(Cast('payload', TextField()))
+    chain = F('version') - F('base_version') + 1
+    figures = InstanceVersion.objects.using(shard_for(dynamic_model)).filter(
+        dynamic_model_id=dynamic_model.pk
+    ).aggregate(
+        instances=Count('instance_id', distinct=True),
+        versions=Count('id'),
+        snapshots=Count('id', filter=Q(is_snapshot=True)),
+        snapshot_bytes=Sum(size, filter=Q(is_snapshot=True), default=0),
+        delta_bytes=Sum(size, filter=Q(is_snapshot=False), default=0),
+        avg_rows_per_read=Avg(chain, filter=Q(is_deleted=False)),
+        max_rows_per_read=Max(chain, filter=Q(is_deleted=False)),
+    )
+    # What storing a full copy of ``data`` on every save would have cost
+    avg_snapshot = figures['snapshot_bytes'] / figures['snapshots'] if figures['snapshots'] else 0
+    figures['full_copy_bytes_estimate'] = round(avg_snapshot * figures['versions'])
+    stored = figures['snapshot_bytes'] + figures['delta_bytes']
+    figures['storage_ratio'] = round(stored / figures['full_copy_bytes_estimate'], 3) if stored and avg_snapshot else None
+    return figures
@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from dynamic_app import changelog
+from dynamic_app.partitioning import shard_aliases
+
+
+class Command(BaseCommand):
+    help = "Drop change log entries past retention and collapse older entries per object."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-days', type=int, default=settings.CHANGELOG_RETENTION_DAYS)
+        parser.add_argument('--compact-after-hours', type=int, default=settings.CHANGELOG_COMPACT_AFTER_HOURS)
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        for alias in shard_aliases():
+            expired = changelog.expire(alias, now - timedelta(days=options['retention_days']))
+            compacted = changelog.compact(alias, now - timedelta(hours=options['compact_after_hours']))
+            self.stdout.write(f"{alias}: removed {expired} expired and {compacted} compacted entries")
@@ -0,0 +1,62 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from dynamic_app import schema
+from dynamic_app.models import DynamicModel
+
+
+class Command(BaseCommand):
+    help = "Export a DynamicModel definition, or create/update one from a JSON or YAML schema file."
+
+    def add_arguments(self, parser):
+        subcommands = parser.add_subparsers(dest='action', required=True)
+
+        export = subcommands.add_parser('export')
+        export.add_argument('model', help='DynamicModel name')
+        export.add_argument('--format', choices=['json', 'yaml'], default='json')
+
+        apply = subcommands.add_parser('apply')
+        apply.add_argument('path', help='Schema file (.json, .yaml or .yml)')
+        apply.add_argument('--user', required=True, help='Username that owns new models and fields')
+        apply.add_argument('--prune', action='store_true', help='Remove fields missing from the schema')
+        apply.add_argument('--dry-run', action='store_true', help='Only print the diff')
+
+    def handle(self, *args, **options):
+        try:
+            if options['action'] == 'export':
+                self.export(options)
+            else:
+                self.apply(options)
+        except ValidationError as e:
+            raise CommandError(e.messages[0])
+
+    def export(self, options):
+        try:
+            model = DynamicModel.objects.get(name=options['model'])
+        except DynamicModel.DoesNotExist:
+            raise CommandError(f"DynamicModel '{options['model']}' does not exist.")
+        self.stdout.write(schema.dumps(schema.export_schema(model), options['format']))
+
+    def apply(self, options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f"User '{options['user']}' does not exist.")
+        with open(options['path']) as f:
+            definition = schema.loads(f.read(), 'yaml' if options['path'].endswith(('.yaml', '.yml')) else 'json')
+
+        model = None
+        if isinstance(definition, dict):
+            model = DynamicModel.objects.filter(name=definition.get('name'), created_by=user).first()
+        model, diff = schema.apply_schema(
+            definition, user, model, prune=options['prune'], dry_run=options['dry_run']
+        )
+
+        self.stdout.write(json.dumps(diff, indent=2))
+        if not diff:
+            self.stdout.write(self.style.SUCCESS("Schema already up to date."))
+        elif not options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(f"Applied schema to {model.name} (id {model.pk})."))
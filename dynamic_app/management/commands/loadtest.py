@@ -0,0 +1,313 @@
+import asyncio
+import json
+import logging
+import random
+import time
+import uuid
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.utils.crypto import get_random_string
+
+from dynamic_app import changelog
+from dynamic_app.models import (
+    ChangeLogEntry, DynamicField, DynamicFieldFile, DynamicModel, InstanceBlob, InstanceVersion,
+)
+from dynamic_app.partitioning import instances_for, shard_aliases
+
+DEFAULT_MIX = 'instance_create=30,instance_list=30,upload_file=10,dynamic_instance_search=30'
+HOST = 'localhost'
+PDF_CONTENT = b'%PDF-1.4\n% loadtest\n'
+
+
+class LockErrorCounter(logging.Handler):
+    """Counts requests that failed because SQLite could not get its lock in time."""
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+
+    def emit(self, record):
+        if record.exc_info and 'database is locked' in str(record.exc_info[1]):
+            self.count += 1
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return round(sorted_values[index] * 1000, 2)
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    return {
+        'p50_ms': percentile(latencies, 50),
+        'p90_ms': percentile(latencies, 90),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': round(latencies[-1] * 1000, 2) if latencies else None,
+    }
+
+
+def multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: application/pdf\r\n\r\n'.encode() + content + b'\r\n'
+        )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+async def call_asgi(application, method, path, session, query='', body=b'', content_type=None):
+    """Send one HTTP request through the ASGI application and return the status code."""
+    headers = [
+        (b'host', HOST.encode()),
+        (b'cookie', f"sessionid={session['sessionid']}; {settings.CSRF_COOKIE_NAME}={session['csrftoken']}".encode()),
+        (b'x-csrftoken', session['csrftoken'].encode()),
+        (b'content-length', str(len(body)).encode()),
+    ]
+    if content_type:
+        headers.append((b'content-type', content_type.encode()))
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'root_path': '',
+        'headers': headers,
+        'client': ('127.0.0.1', 0),
+        'server': (HOST, 80),
+    }
+    finished = asyncio.Event()
+    request_sent = False
+    response = {}
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        await finished.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+        elif message['type'] == 'http.response.body' and not message.get('more_body'):
+            finished.set()
+
+    await application(scope, receive, send)
+    finished.set()
+    return response.get('status', 0)
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive core.asgi.application in-process with concurrent authenticated clients replaying a "
+        "mixed workload, and report throughput, tail latency and lock errors per concurrency level as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', default='1,4,16',
+                            help='Comma-separated concurrency levels; each level is one point of the saturation curve')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds to run each concurrency level')
+        parser.add_argument('--users', type=int, default=4, help='Authenticated sessions to spread requests over')
+        parser.add_argument('--seed-instances', type=int, default=200, help='Instances seeded per user model')
+        parser.add_argument('--mix', default=DEFAULT_MIX, help=f'Workload weights (default: {DEFAULT_MIX})')
+        parser.add_argument('--random-seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the seeded users, models and instances, and their change log and history')
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(level) for level in options['concurrency'].split(',')]
+            mix = {name: float(weight) for name, weight in (item.split('=') for item in options['mix'].split(','))}
+        except ValueError:
+            raise CommandError("Use --concurrency 1,4,16 and --mix name=weight,name=weight.")
+        unknown = set(mix) - {'instance_create', 'instance_list', 'upload_file', 'dynamic_instance_search'}
+        if unknown:
+            raise CommandError(f"Unknown workload operations: {', '.join(sorted(unknown))}")
+
+        # Building the ASGI app reconfigures logging, so it has to happen before the handler swap below
+        from core.asgi import application
+
+        run_id = get_random_string(6).lower()
+        sessions = self.seed(run_id, options['users'], options['seed_instances'])
+        lock_errors = LockErrorCounter()
+        request_logger = logging.getLogger('django.request')
+        saved_handlers, saved_propagate = request_logger.handlers, request_logger.propagate
+        request_logger.handlers, request_logger.propagate = [lock_errors], False
+        try:
+            levels_report = []
+            for concurrency in levels:
+                lock_errors.count = 0
+                results, elapsed = asyncio.run(self.run_level(
+                    application, sessions, mix, concurrency, options['duration'], options['random_seed']
+                ))
+                levels_report.append(self.summarize(concurrency, results, elapsed, lock_errors.count))
+                self.stderr.write(
+                    f"concurrency {concurrency}: {levels_report[-1]['throughput_rps']} req/s, "
+                    f"p99 {levels_report[-1]['latency']['p99_ms']} ms"
+                )
+        finally:
+            request_logger.handlers, request_logger.propagate = saved_handlers, saved_propagate
+            if not options['keep']:
+                self.cleanup(sessions)
+
+        report = {
+            'database': connections['default'].vendor,
+            'duration_per_level_s': options['duration'],
+            'users': options['users'],
+            'mix': mix,
+            'levels': levels_report,
+            'saturation': self.saturation(levels_report),
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+    def seed(self, run_id, users, instances):
+        """One user per session, each owning a model with seeded instances."""
+        sessions = []
+        for n in range(users):
+            user = User.objects.create_user(f'loadtest_{run_id}_{n}', password=get_random_string(20))
+            model = DynamicModel.objects.create(name=f'loadtest_{run_id}_{n}', created_by=user)
+            fields = {
+                name: DynamicField.objects.create(
+                    dynamic_model=model, name=name, display_name=name.title(), field_type=field_type,
+                    is_unique=False, display_order=order, created_by=user,
+                )
+                for order, (name, field_type) in enumerate([('title', 'char'), ('qty', 'int'), ('notes', 'text'), ('doc', 'file')])
+            }
+            instance_ids = [
+                instances_for(model).create(dynamic_model=model, created_by=user, data={
+                    'title': f'item {i}', 'qty': str(i), 'notes': f'seeded row {i} for load testing',
+                }).pk
+                for i in range(instances)
+            ]
+            client = Client()
+            client.force_login(user)
+            sessions.append({
+                'user': user,
+                'model': model,
+                'file_field': fields['doc'].pk,
+                'instance_ids': instance_ids,
+                'sessionid': client.cookies[settings.SESSION_COOKIE_NAME].value,
+                'csrftoken': get_random_string(32),
+            })
+        return sessions
+
+    def request_for(self, operation, session, rng):
+        model_pk = session['model'].pk
+        if operation == 'instance_create':
+            body = urlencode({
+                'title': f'load {rng.random()}', 'qty': str(rng.randint(1, 1000)), 'notes': 'created under load',
+            }).encode()
+            return 'POST', f'/models/{model_pk}/instances/create/', '', body, 'application/x-www-form-urlencoded'
+        if operation == 'instance_list':
+            return 'GET', f'/models/{model_pk}/instances/', '', b'', None
+        if operation == 'upload_file':
+            instance_id = rng.choice(session['instance_ids'])
+            body, content_type = multipart({}, {'file': ('load.pdf', PDF_CONTENT)})
+            return 'POST', f"/instances/{instance_id}/fields/{session['file_field']}/upload/", '', body, content_type
+        return 'GET', '/search/', urlencode({'q': f'item {rng.randint(0, 99)}'}), b'', None
+
+    async def run_level(self, application, sessions, mix, concurrency, duration, seed):
+        operations, weights = list(mix), list(mix.values())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + duration
+        results = []
+
+        async def worker(n):
+            rng = random.Random(seed * 1000 + n)
+            session = sessions[n % len(sessions)]
+            while loop.time() < deadline:
+                operation = rng.choices(operations, weights)[0]
+                method, path, query, body, content_type = self.request_for(operation, session, rng)
+                started = time.perf_counter()
+                status = await call_asgi(application, method, path, session, query, body, content_type)
+                results.append((operation, status, time.perf_counter() - started))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(n) for n in range(concurrency)))
+        return results, time.perf_counter() - started
+
+    def summarize(self, concurrency, results, elapsed, lock_errors):
+        by_operation = {}
+        for operation, status, latency in results:
+            by_operation.setdefault(operation, []).append((status, latency))
+
+        def stats(rows):
+            statuses = {}
+            for status, _ in rows:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+            return {
+                'requests': len(rows),
+                'errors': sum(1 for status, _ in rows if status >= 500 or status == 0),
+                'statuses': statuses,
+                'latency': latency_summary([latency for _, latency in rows]),
+            }
+
+        summary = stats([(status, latency) for _, status, latency in results])
+        return {
+            'concurrency': concurrency,
+            'elapsed_s': round(elapsed, 3),
+            'throughput_rps': round(len(results) / elapsed, 2) if elapsed else 0,
+            **summary,
+            'sqlite_lock_errors': lock_errors,
+            'operations': {operation: stats(rows) for operation, rows in sorted(by_operation.items())},
+        }
+
+    def saturation(self, levels):
+        """The concurrency after which adding clients stops raising throughput by at least 10%."""
+        curve = [{
+            'concurrency': level['concurrency'],
+            'throughput_rps': level['throughput_rps'],
+            'p99_ms': level['latency']['p99_ms'],
+        } for level in sorted(levels, key=lambda level: level['concurrency'])]
+        saturated_at = None
+        for previous, current in zip(curve, curve[1:]):
+            if current['throughput_rps'] < previous['throughput_rps'] * 1.1:
+                saturated_at = previous['concurrency']
+                break
+        return {'curve': curve, 'saturated_at_concurrency': saturated_at}
+
+    def cleanup(self, sessions):
+        """
+        Delete everything the run wrote: files, instances, models, users and their
+        shard copies, and the change log, history and blob rows of the seeded models.
+        """
+        model_ids = [session['model'].pk for session in sessions]
+        user_ids = [session['user'].pk for session in sessions]
+        # Deleting is part of the cleanup, not a change for CDC consumers to replay
+        with changelog.suppressed():
+            for session in sessions:
+                for file in DynamicFieldFile.objects.using(instances_for(session['model']).db).filter(
+                    instance__dynamic_model=session['model']
+                ):
+                    file.delete()
+                instances_for(session['model']).delete()
+                session['model'].delete()
+                session['user'].delete()
+        for alias in shard_aliases():
+            for model in (ChangeLogEntry, InstanceVersion, InstanceBlob):
+                model.objects.using(alias).filter(dynamic_model_id__in=model_ids).delete()
+            if alias != 'default':
+                User.objects.using(alias).filter(pk__in=user_ids).delete()
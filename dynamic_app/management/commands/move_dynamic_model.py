@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from dynamic_app.models import DynamicModel
+from dynamic_app.partitioning import move_dynamic_model, shard_for, shard_aliases
+
+
+class Command(BaseCommand):
+    help = "Move a DynamicModel's instances and file rows to another shard while it stays online."
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='DynamicModel id or name')
+        parser.add_argument('shard', nargs='?', help="Target database alias; omit to show the current placement")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        lookup = {'pk': options['model']} if options['model'].isdigit() else {'name': options['model']}
+        try:
+            model = DynamicModel.objects.get(**lookup)
+        except DynamicModel.DoesNotExist:
+            raise CommandError(f"DynamicModel '{options['model']}' does not exist.")
+
+        if not options['shard']:
+            self.stdout.write(f"{model.name} is stored on '{shard_for(model)}' "
+                              f"(shards: {', '.join(shard_aliases())})")
+            return
+
+        if options['shard'] not in shard_aliases():
+            raise CommandError(f"Unknown shard '{options['shard']}'. Configured shards: {', '.join(shard_aliases())}")
+
+        source = shard_for(model)
+        moved = move_dynamic_model(model, options['shard'], options['batch_size'], log=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(
+            f"Moved {moved} instances of {model.name} from '{source}' to '{options['shard']}'."
+        ))
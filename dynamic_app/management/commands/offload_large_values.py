@@ -0,0 +1,74 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from dynamic_app import offload
+from dynamic_app.models import DynamicModel, DynamicModelInstance, InstanceBlob
+from dynamic_app.partitioning import instances_for, shard_for
+
+
+class Command(BaseCommand):
+    help = (
+        "Move large text and file values of existing instances out of their data into compressed "
+        "InstanceBlob rows, in batches, and report the space saved."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', nargs='?', help='DynamicModel id or name (default: every model)')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be offloaded without writing')
+
+    def handle(self, *args, **options):
+        models = DynamicModel.objects.all()
+        if options['model']:
+            lookup = {'pk': options['model']} if options['model'].isdigit() else {'name': options['model']}
+            models = models.filter(**lookup)
+            if not models.exists():
+                raise CommandError(f"DynamicModel '{options['model']}' does not exist.")
+
+        totals = {'rows': 0, 'before': 0, 'after': 0, 'stored': 0}
+        for model in models:
+            counts = self.offload_model(model, options['batch_size'], options['dry_run'])
+            if counts['rows']:
+                self.stdout.write(f"{model.name}: {counts['rows']} instances rewritten")
+            for key in totals:
+                totals[key] += counts[key]
+
+        saved = totals['before'] - totals['after'] - totals['stored']
+        verb = 'Would rewrite' if options['dry_run'] else 'Rewrote'
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {totals['rows']} instances: inline data {totals['before']} -> {totals['after']} bytes, "
+            f"{totals['stored']} bytes in blobs, {saved} bytes saved."
+        ))
+
+    def offload_model(self, model, batch_size, dry_run):
+        fields = [field for field in model.fields.all() if field.field_type in offload.OFFLOADED_TYPES]
+        counts = {'rows': 0, 'before': 0, 'after': 0, 'stored': 0}
+        if not fields:
+            return counts
+
+        alias = shard_for(model)
+        last_pk = 0
+        while True:
+            batch = list(instances_for(model).filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            rewritten, blobs = [], []
+            for instance in batch:
+                before = len(offload.encode(instance.data))
+                pending = offload.extract(instance, fields)
+                if not pending:
+                    continue
+                rewritten.append(instance)
+                blobs += offload.blobs_for(instance, pending, alias)
+                counts['before'] += before
+                counts['after'] += len(offload.encode(instance.data))
+            counts['rows'] += len(rewritten)
+            counts['stored'] += sum(blob.stored_size for blob in blobs)
+            if dry_run or not rewritten:
+                continue
+            # The logical values are unchanged, so neither the change log nor the history records this
+            with transaction.atomic(using=alias):
+                InstanceBlob.objects.using(alias).bulk_create(blobs)
+                DynamicModelInstance.objects.using(alias).bulk_update(rewritten, ['data'])
+        return counts
@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from dynamic_app import history
+from dynamic_app.partitioning import shard_aliases
+
+
+class Command(BaseCommand):
+    help = "Remove old instance versions while keeping every remaining version readable."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-days', type=int, default=settings.HISTORY_RETENTION_DAYS)
+        parser.add_argument('--keep-versions', type=int, default=settings.HISTORY_KEEP_VERSIONS,
+                            help='Versions to keep per instance regardless of age')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['retention_days'])
+        for alias in shard_aliases():
+            removed = history.prune(alias, before, max(options['keep_versions'], 1))
+            self.stdout.write(f"{alias}: removed {removed} versions")
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from dynamic_app import computed
+from dynamic_app.models import DynamicModel
+
+
+class Command(BaseCommand):
+    help = "Recompute persisted computed fields for every instance of a DynamicModel, in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='DynamicModel id or name')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        lookup = {'pk': options['model']} if options['model'].isdigit() else {'name': options['model']}
+        try:
+            model = DynamicModel.objects.get(**lookup)
+        except DynamicModel.DoesNotExist:
+            raise CommandError(f"DynamicModel '{options['model']}' does not exist.")
+
+        if not any(field.field_type == 'computed' and field.persist_result for field in model.fields.all()):
+            self.stdout.write(f"{model.name} has no persisted computed fields.")
+            return
+
+        scanned, updated = computed.recompute(model, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Recomputed {scanned} instances of {model.name}; {updated} changed."))
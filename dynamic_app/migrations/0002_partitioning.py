@@ -0,0 +1,31 @@
+# Generated by Django 5.1.4 on 2026-10-19 02:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dynamic_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PartitionSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('last_value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DynamicModelPlacement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('db_alias', models.CharField(default='default', max_length=100)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('dynamic_model', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='placement', to='dynamic_app.dynamicmodel')),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.4 on 2026-10-19 02:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dynamic_app', '0002_partitioning'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLogEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dynamic_model_id', models.BigIntegerField()),
+                ('object_type', models.CharField(choices=[('instance', 'DynamicModelInstance'), ('field', 'DynamicField'), ('file', 'DynamicFieldFile')], max_length=20)),
+                ('object_id', models.BigIntegerField()),
+                ('action', models.CharField(choices=[('create', 'Create'), ('update', 'Update'), ('delete', 'Delete')], max_length=10)),
+                ('changes', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['dynamic_model_id', 'id'], name='dynamic_app_dynamic_1f051e_idx'), models.Index(fields=['object_type', 'object_id'], name='dynamic_app_object__f76bae_idx')],
+            },
+        ),
+    ]
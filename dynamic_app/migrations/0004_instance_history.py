@@ -0,0 +1,33 @@
+# Generated by Django 5.1.4 on 2026-10-19 02:16
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dynamic_app', '0003_changelog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InstanceVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('instance_id', models.BigIntegerField()),
+                ('dynamic_model_id', models.BigIntegerField()),
+                ('version', models.PositiveIntegerField()),
+                ('base_version', models.PositiveIntegerField()),
+                ('is_snapshot', models.BooleanField(default=False)),
+                ('is_deleted', models.BooleanField(default=False)),
+                ('payload', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'ordering': ['instance_id', 'version'],
+                'indexes': [models.Index(fields=['dynamic_model_id', 'created_at'], name='dynamic_app_dynamic_551673_idx')],
+                'unique_together': {('instance_id', 'version')},
+            },
+        ),
+    ]
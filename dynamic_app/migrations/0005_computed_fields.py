@@ -0,0 +1,28 @@
+# Generated by Django 5.1.4 on 2026-10-19 02:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dynamic_app', '0004_instance_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dynamicfield',
+            name='expression',
+            field=models.TextField(blank=True, help_text='Formula for computed fields, e.g. price * qty'),
+        ),
+        migrations.AddField(
+            model_name='dynamicfield',
+            name='persist_result',
+            field=models.BooleanField(default=False, help_text='Store computed values in the instance data'),
+        ),
+        migrations.AlterField(
+            model_name='dynamicfield',
+            name='field_type',
+            field=models.CharField(choices=[('char', 'Character'), ('text', 'Text'), ('int', 'Integer'), ('decimal', 'Decimal'), ('bool', 'Boolean'), ('date', 'Date'), ('datetime', 'DateTime'), ('file', 'File'), ('choice', 'Choice'), ('computed', 'Computed')], max_length=20),
+        ),
+    ]
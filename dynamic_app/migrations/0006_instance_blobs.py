@@ -0,0 +1,31 @@
+# Generated by Django 5.1.4 on 2026-10-19 02:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dynamic_app', '0005_computed_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InstanceBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('instance_id', models.BigIntegerField()),
+                ('dynamic_model_id', models.BigIntegerField(db_index=True)),
+                ('field_name', models.CharField(max_length=100)),
+                ('digest', models.CharField(max_length=64)),
+                ('codec', models.CharField(choices=[('none', 'Uncompressed'), ('zlib', 'zlib'), ('zstd', 'Zstandard')], max_length=10)),
+                ('content', models.BinaryField()),
+                ('raw_size', models.PositiveIntegerField()),
+                ('stored_size', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('instance_id', 'digest')},
+            },
+        ),
+    ]
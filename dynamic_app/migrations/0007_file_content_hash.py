@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-19 02:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dynamic_app', '0006_instance_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dynamicfieldfile',
+            name='content_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+    ]
@@ -1,8 +1,14 @@
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from django.db import router, transaction
+from django.utils import timezone
+from .partitioning import shard_for, shard_aliases
+import hashlib
 import json  
 import os   
+import threading
     
 def validate_file_type(value):
     allowed_extensions = ['.docx', '.csv', '.pdf']
@@ -10,6 +16,18 @@ def validate_file_type(value):
     if ext not in allowed_extensions:
         raise ValidationError(f"Unsupported file type. Allowed types are: {', '.join(allowed_extensions)}")
 
+class ChangeLoggedModel(models.Model):
+    """Saves run in a transaction so the ChangeLogEntry written on post_save commits with the row."""
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+
+
 class DynamicModel(models.Model):
     name = models.CharField(max_length=100, unique=True)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -19,7 +37,7 @@ class DynamicModel(models.Model):
     def __str__(self):
         return self.name
 
-class DynamicField(models.Model):
+class DynamicField(ChangeLoggedModel):
     FIELD_TYPES = [
         ('char', 'Character'),
         ('text', 'Text'),
@@ -30,6 +48,7 @@ class DynamicField(models.Model):
         ('datetime', 'DateTime'),
         ('file', 'File'),
         ('choice', 'Choice'),
+        ('computed', 'Computed'),
     ]
 
     dynamic_model = models.ForeignKey(DynamicModel, on_delete=models.CASCADE, related_name='fields')
@@ -40,6 +59,8 @@ class DynamicField(models.Model):
     is_unique = models.BooleanField(default=True)
     is_readonly = models.BooleanField(default=False)
     display_order = models.IntegerField(default=0)
+    expression = models.TextField(blank=True, help_text='Formula for computed fields, e.g. price * qty')
+    persist_result = models.BooleanField(default=False, help_text='Store computed values in the instance data')
     created_by = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -52,6 +73,40 @@ class DynamicField(models.Model):
         if self.field_type == 'file' and self.is_unique:
             raise ValidationError("File fields cannot be marked as unique.")
 
+        from .computed import computed_fields, formula_errors
+        siblings = list(self.dynamic_model.fields.exclude(pk=self.pk)) if self.dynamic_model_id else []
+        if self.field_type != 'computed' and not any(field.field_type == 'computed' for field in siblings):
+            return
+        # Renaming or retyping a field must not break the formulas that read it, but
+        # formulas that were broken already are left for their own edit to fix
+        original = DynamicField.objects.filter(pk=self.pk).first() if self.pk else None
+        before = formula_errors([*siblings, original] if original else siblings)
+        after = formula_errors([*siblings, self])
+        if self.name in after:
+            raise ValidationError({'expression': [after.pop(self.name)]})
+        broken = {name: message for name, message in after.items() if name not in before}
+        if broken:
+            raise ValidationError({'name': [
+                f"Computed field '{name}' would stop working: {message}" for name, message in broken.items()
+            ]})
+        if not after:
+            try:
+                computed_fields([*siblings, self])
+            except ValidationError as e:
+                raise ValidationError({'expression' if self.field_type == 'computed' else 'field_type': e.messages})
+
+    def delete(self, *args, **kwargs):
+        from .computed import formula_errors
+        siblings = list(self.dynamic_model.fields.exclude(pk=self.pk))
+        before = formula_errors([*siblings, self])
+        broken = [name for name in formula_errors(siblings) if name not in before]
+        if broken:
+            raise ValidationError(
+                f"Field '{self.name}' is read by computed field{'s' if len(broken) > 1 else ''} "
+                f"{', '.join(broken)}; change {'their' if len(broken) > 1 else 'its'} expression first."
+            )
+        return super().delete(*args, **kwargs)
+
     def __str__(self):
         return f"{self.dynamic_model.name} - {self.name}"
 
@@ -71,12 +126,14 @@ def file_upload_path(instance, filename):
     # Create a path like: dynamic_files/model_name/field_name/filename
     return f'dynamic_files/{instance.instance.dynamic_model.name}/{instance.field.name}/{filename}'
 
-class DynamicFieldFile(models.Model):
+class DynamicFieldFile(ChangeLoggedModel):
     instance = models.ForeignKey('DynamicModelInstance', on_delete=models.CASCADE, related_name='files')
     field = models.ForeignKey(DynamicField, on_delete=models.CASCADE)
     file = models.FileField(upload_to=file_upload_path, validators=[validate_file_type])
     file_name = models.CharField(max_length=255)
     file_extension = models.CharField(max_length=10)
+    # sha256 of the stored bytes, used as the download ETag
+    content_hash = models.CharField(max_length=64, blank=True, editable=False)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
     def __init__(self, *args, **kwargs):
@@ -84,6 +141,11 @@ class DynamicFieldFile(models.Model):
         self._original_file = self.file if self.pk else None
 
     def save(self, *args, **kwargs):
+        if self.pk is None:
+            # Instance rows may live on any shard, so ids come from one global sequence
+            self.pk = PartitionSequence.next_id(DynamicFieldFile)
+            kwargs['force_insert'] = True
+
         if self.file:
             # Extract filename without path
             filename = os.path.basename(self.file.name)
@@ -95,11 +157,24 @@ class DynamicFieldFile(models.Model):
             if self.pk and self._original_file and self._original_file != self.file:
                 # Delete old file if it's being replaced
                 self._original_file.delete(save=False)
+
+            if not self.file._committed or not self.content_hash:
+                self.content_hash = self.compute_content_hash()
         
         super().save(*args, **kwargs)
         # Update the reference to the current file
         self._original_file = self.file
 
+    def compute_content_hash(self):
+        committed = self.file._committed
+        digest = hashlib.sha256()
+        for chunk in self.file.chunks():
+            digest.update(chunk)
+        if committed:
+            # An upload still has to be written to storage, so only close files opened from there
+            self.file.close()
+        return digest.hexdigest()
+
     def delete(self, *args, **kwargs):
         # Delete the actual file when the model instance is deleted
         if self.file:
@@ -109,13 +184,28 @@ class DynamicFieldFile(models.Model):
     def __str__(self):
         return f"File for {self.instance} - {self.field.name}"
 
-class DynamicModelInstance(models.Model):
+class DynamicModelInstance(ChangeLoggedModel):
     dynamic_model = models.ForeignKey(DynamicModel, on_delete=models.CASCADE)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     data = models.JSONField()
 
+    def save(self, *args, **kwargs):
+        if self.pk is None:
+            # Instance rows may live on any shard, so ids come from one global sequence
+            self.pk = PartitionSequence.next_id(DynamicModelInstance)
+            kwargs['force_insert'] = True
+        super().save(*args, **kwargs)
+
+    def get_value(self, name):
+        """A field's value, loaded from its InstanceBlob when it was offloaded."""
+        from .offload import is_ref, resolve
+        value = (self.data or {}).get(name)
+        if is_ref(value):
+            value = resolve({self.pk: {name: value}}, self._state.db)[self.pk][name]
+        return value
+
     def clean(self):
         errors = {}
         fields = self.dynamic_model.fields.all()
@@ -123,7 +213,7 @@ class DynamicModelInstance(models.Model):
         for field in fields:
             value = self.data.get(field.name)
 
-            if field.is_required and not value and field.field_type != 'file':
+            if field.is_required and not value and field.field_type not in ('file', 'computed'):
                 errors[field.name] = 'This field is required.'
 
             if field.field_type == 'choice' and value:
@@ -132,7 +222,7 @@ class DynamicModelInstance(models.Model):
                     errors[field.name] = f"Invalid choice: {value}. Valid choices are: {', '.join(valid_choices)}."
 
             if value and field.is_unique and field.field_type != 'file':
-                if DynamicModelInstance.objects.filter(
+                if DynamicModelInstance.objects.using(self._state.db or shard_for(self.dynamic_model_id)).filter(
                     dynamic_model=self.dynamic_model,
                     data__contains={field.name: value}
                 ).exclude(pk=self.pk).exists():
@@ -143,9 +233,168 @@ class DynamicModelInstance(models.Model):
 
     def __str__(self):
         return f"{self.dynamic_model.name} Instance - {self.pk}"
-    
-    
-    
-    
-    
-    
\ No newline at end of file
+
+
+class DynamicModelPlacement(models.Model):
+    """Maps a DynamicModel to the database alias that stores its instances and files."""
+    dynamic_model = models.OneToOneField(DynamicModel, on_delete=models.CASCADE, related_name='placement')
+    db_alias = models.CharField(max_length=100, default='default')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.dynamic_model.name} -> {self.db_alias}"
+
+
+# Ids this process reserved but has not handed out yet: {model label: (pid, iterator)}
+_id_blocks = {}
+_id_blocks_lock = threading.Lock()
+
+
+class PartitionSequence(models.Model):
+    """Global id sequence for rows that can be spread over several shards."""
+    name = models.CharField(max_length=100, unique=True)
+    last_value = models.BigIntegerField(default=0)
+
+    @classmethod
+    def allocate(cls, model, count=1):
+        """Reserve ``count`` consecutive ids for ``model`` and return them as a range."""
+        with transaction.atomic(using='default'):
+            sequence = cls.objects.using('default').select_for_update().filter(name=model._meta.label).first()
+            if sequence is None:
+                # First use: start after the highest id already stored on any shard
+                start = max(
+                    model._base_manager.using(alias).aggregate(m=models.Max('pk'))['m'] or 0
+                    for alias in shard_aliases()
+                )
+                sequence = cls.objects.using('default').create(name=model._meta.label, last_value=start)
+            first = sequence.last_value + 1
+            sequence.last_value += count
+            sequence.save(using='default', update_fields=['last_value'])
+        return range(first, first + count)
+
+    @classmethod
+    def next_id(cls, model):
+        """
+        The next id for ``model`` from a block this process reserved, so only one
+        insert in DYNAMIC_MODEL_ID_BLOCK_SIZE has to write to ``default``.
+        """
+        label = model._meta.label
+        with _id_blocks_lock:
+            pid, ids = _id_blocks.get(label, (None, None))
+            # A forked worker must not hand out ids from its parent's block
+            value = next(ids, None) if pid == os.getpid() else None
+            if value is None:
+                ids = iter(cls.allocate(model, getattr(settings, 'DYNAMIC_MODEL_ID_BLOCK_SIZE', 100)))
+                value = next(ids)
+                _id_blocks[label] = (os.getpid(), ids)
+        return value
+
+    @classmethod
+    def clear_blocks(cls):
+        """Forget the reserved blocks; their unused ids are skipped."""
+        _id_blocks.clear()
+
+    def __str__(self):
+        return f"{self.name}: {self.last_value}"
+
+
+class ChangeLogEntry(models.Model):
+    """
+    Append-only record of a create, update or delete. Entries are written on the
+    same database as the row they describe, so ``id`` is a per-shard cursor.
+    """
+    ACTIONS = [
+        ('create', 'Create'),
+        ('update', 'Update'),
+        ('delete', 'Delete'),
+    ]
+    OBJECT_TYPES = [
+        ('instance', 'DynamicModelInstance'),
+        ('field', 'DynamicField'),
+        ('file', 'DynamicFieldFile'),
+    ]
+
+    dynamic_model_id = models.BigIntegerField()
+    object_type = models.CharField(max_length=20, choices=OBJECT_TYPES)
+    object_id = models.BigIntegerField()
+    action = models.CharField(max_length=10, choices=ACTIONS)
+    changes = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['dynamic_model_id', 'id']),
+            models.Index(fields=['object_type', 'object_id']),
+        ]
+
+    def __str__(self):
+        return f"{self.action} {self.object_type} {self.object_id}"
+
+
+class ChangeLogHorizon(models.Model):
+    """
+    The highest ChangeLogEntry id that retention has deleted for a DynamicModel,
+    kept on the same database as the entries. A cursor below it has missed changes.
+    """
+    dynamic_model_id = models.BigIntegerField(unique=True)
+    expired_through = models.BigIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Changes of model {self.dynamic_model_id} expired through {self.expired_through}"
+
+
+class InstanceVersion(models.Model):
+    """
+    One version of a DynamicModelInstance's ``data``. Snapshots hold the full data;
+    other versions hold a diff against the previous version, back to ``base_version``.
+    Versions are kept on the instance's shard and survive the instance's deletion.
+    """
+    instance_id = models.BigIntegerField()
+    dynamic_model_id = models.BigIntegerField()
+    version = models.PositiveIntegerField()
+    base_version = models.PositiveIntegerField()
+    is_snapshot = models.BooleanField(default=False)
+    is_deleted = models.BooleanField(default=False)
+    payload = models.JSONField(default=dict)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['instance_id', 'version']
+        unique_together = ['instance_id', 'version']
+        indexes = [
+            models.Index(fields=['dynamic_model_id', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"Instance {self.instance_id} v{self.version}"
+
+
+class InstanceBlob(models.Model):
+    """
+    A large ``data`` value moved out of its DynamicModelInstance row and compressed.
+    Like InstanceVersion, blobs survive the instance's deletion so its history stays
+    readable; ``history.prune`` removes blobs that nothing references any more.
+    """
+    CODECS = [
+        ('none', 'Uncompressed'),
+        ('zlib', 'zlib'),
+        ('zstd', 'Zstandard'),
+    ]
+
+    instance_id = models.BigIntegerField()
+    dynamic_model_id = models.BigIntegerField(db_index=True)
+    field_name = models.CharField(max_length=100)
+    digest = models.CharField(max_length=64)
+    codec = models.CharField(max_length=10, choices=CODECS)
+    content = models.BinaryField()
+    raw_size = models.PositiveIntegerField()
+    stored_size = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['instance_id', 'digest']
+
+    def __str__(self):
+        return f"Blob {self.digest[:12]} of {self.instance_id}.{self.field_name}"
@@ -0,0 +1,199 @@
+"""
+Offloading of large text and file-metadata values out of ``DynamicModelInstance.data``.
+
+A value whose JSON encoding is larger than ``BLOB_OFFLOAD_THRESHOLD`` bytes is
+compressed into an InstanceBlob on the instance's shard. Only a small reference
+stays inline::
+
+    {"$blob": "<sha256 of the value>", "size": 48213, "preview": "first characters..."}
+
+Blobs are addressed by content, so an unchanged value is never written twice,
+and the history of an instance keeps pointing at the value it had at the time.
+"""
+import hashlib
+import json
+import zlib
+
+from django.conf import settings
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional; zlib ships with Python
+    zstandard = None
+
+OFFLOADED_TYPES = ('text', 'file')
+REF_KEY = '$blob'
+
+
+def threshold():
+    return getattr(settings, 'BLOB_OFFLOAD_THRESHOLD', 2048)
+
+
+def is_ref(value):
+    return isinstance(value, dict) and REF_KEY in value
+
+
+def encode(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def compress(raw):
+    """Return ``(codec, content)``, keeping the data uncompressed when that is smaller."""
+    if zstandard is not None:
+        codec, content = 'zstd', zstandard.ZstdCompressor(level=9).compress(raw)
+    else:
+        codec, content = 'zlib', zlib.compress(raw, 9)
+    return (codec, content) if len(content) < len(raw) else ('none', raw)
+
+
+def decompress(codec, content):
+    content = bytes(content)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("This blob is zstd-compressed; install the 'zstandard' package to read it.")
+        return zstandard.ZstdDecompressor().decompress(content)
+    if codec == 'zlib':
+        return zlib.decompress(content)
+    return content
+
+
+def _preview(value):
+    length = getattr(settings, 'BLOB_PREVIEW_CHARS', 64)
+    return value[:length] if isinstance(value, str) else ''
+
+
+def extract(instance, fields):
+    """
+    Replace large values in ``instance.data`` with references.
+    Returns ``{digest: (field_name, raw_bytes)}`` for ``store()`` to write once the row exists.
+    """
+    pending = {}
+    for field in fields:
+        value = (instance.data or {}).get(field.name)
+        if field.field_type not in OFFLOADED_TYPES or value is None or is_ref(value):
+            continue
+        raw = encode(value)
+        if len(raw) <= threshold():
+            continue
+        digest = hashlib.sha256(raw).hexdigest()
+        pending[digest] = (field.name, raw)
+        instance.data[field.name] = {REF_KEY: digest, 'size': len(raw), 'preview': _preview(value)}
+    return pending
+
+
+def blobs_for(instance, pending, using):
+    """Unsaved InstanceBlob rows for the ``pending`` values that the instance does not store yet."""
+    from .models import InstanceBlob
+
+    if not pending:
+        return []
+    existing = set(InstanceBlob.objects.using(using).filter(
+        instance_id=instance.pk, digest__in=pending
+    ).values_list('digest', flat=True))
+    blobs = []
+    for digest, (field_name, raw) in pending.items():
+        if digest in existing:
+            continue
+        codec, content = compress(raw)
+        blobs.append(InstanceBlob(
+            instance_id=instance.pk, dynamic_model_id=instance.dynamic_model_id,
+            field_name=field_name, digest=digest, codec=codec,
+            content=content, raw_size=len(raw), stored_size=len(content),
+        ))
+    return blobs
+
+
+def store(instance, pending, using):
+    from .models import InstanceBlob
+
+    InstanceBlob.objects.using(using).bulk_create(blobs_for(instance, pending, using))
+
+
+def _digests(value, found):
+    if is_ref(value):
+        found.add(value[REF_KEY])
+    elif isinstance(value, dict):
+        for item in value.values():
+            _digests(item, found)
+    elif isinstance(value, list):
+        for item in value:
+            _digests(item, found)
+    return found
+
+
+def collect_garbage(instance_id, using):
+    """
+    Delete the blobs of ``instance_id`` that neither the instance's current data
+    nor any of its remaining versions refer to. Returns the number deleted.
+    """
+    from .models import DynamicModelInstance, InstanceBlob, InstanceVersion
+
+    referenced = set()
+    for payload in InstanceVersion.objects.using(using).filter(instance_id=instance_id).values_list('payload', flat=True):
+        _digests(payload, referenced)
+    for data in DynamicModelInstance.objects.using(using).filter(pk=instance_id).values_list('data', flat=True):
+        _digests(data, referenced)
+    deleted, _ = InstanceBlob.objects.using(using).filter(instance_id=instance_id).exclude(digest__in=referenced).delete()
+    return deleted
+
+
+def _load(alias, pairs):
+    """``{(instance_id, digest): value}`` for the requested blobs on ``alias``."""
+    from django.db.models import Q
+    from .models import InstanceBlob
+
+    values = {}
+    pairs = list(pairs)
+    for start in range(0, len(pairs), 500):
+        condition = Q()
+        for instance_id, digest in pairs[start:start + 500]:
+            condition |= Q(instance_id=instance_id, digest=digest)
+        for blob in InstanceBlob.objects.using(alias).filter(condition):
+            values[(blob.instance_id, blob.digest)] = json.loads(decompress(blob.codec, blob.content))
+    return values
+
+
+def inflate(instances):
+    """
+    Swap references for their values in memory, for a whole list of instances
+    with one query per batch of blobs. Saving an inflated instance is safe: the
+    values are offloaded again and match their existing blobs.
+    """
+    instances = list(instances)
+    wanted = {}
+    for instance in instances:
+        for value in (instance.data or {}).values():
+            if is_ref(value):
+                wanted.setdefault(instance._state.db, set()).add((instance.pk, value[REF_KEY]))
+    loaded = {}
+    for alias, pairs in wanted.items():
+        loaded.update(_load(alias, pairs))
+    for instance in instances:
+        if any(is_ref(value) for value in (instance.data or {}).values()):
+            instance.data = {
+                name: loaded.get((instance.pk, value[REF_KEY]), value) if is_ref(value) else value
+                for name, value in instance.data.items()
+            }
+    return instances
+
+
+def resolve(states, using):
+    """
+    Values for ``{instance_id: data}`` dicts that may hold references, e.g.
+    versions read back from the history. References to blobs that no longer
+    exist are left as they are.
+    """
+    pairs = {
+        (instance_id, value[REF_KEY])
+        for instance_id, data in states.items() for value in (data or {}).values() if is_ref(value)
+    }
+    if not pairs:
+        return states
+    loaded = _load(using, pairs)
+    return {
+        instance_id: data and {
+            name: loaded.get((instance_id, value[REF_KEY]), value) if is_ref(value) else value
+            for name, value in data.items()
+        }
+        for instance_id, data in states.items()
+    }
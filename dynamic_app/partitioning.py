@@ -0,0 +1,267 @@
+"""
+Placement of DynamicModel instance storage across database aliases.
+
+The catalog (users, DynamicModel, DynamicField, DynamicFieldChoice) always lives
+on ``default``. Every DynamicModel's instances and file rows live on exactly one
+shard, chosen through ``DynamicModelPlacement``. Shards keep a mirror of the
+catalog rows they reference so foreign keys and joins keep working there.
+"""
+import time
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.http import Http404
+from django.utils import timezone
+
+_placements = {}
+_placements_loaded_at = None
+
+
+def shard_aliases():
+    """All database aliases that may hold instance rows, ``default`` first."""
+    aliases = getattr(settings, 'DYNAMIC_MODEL_SHARDS', ['default'])
+    return ['default'] + [alias for alias in aliases if alias != 'default']
+
+
+def default_shard():
+    return getattr(settings, 'DYNAMIC_MODEL_DEFAULT_SHARD', 'default')
+
+
+def placement_ttl():
+    return getattr(settings, 'DYNAMIC_MODEL_PLACEMENT_TTL', 5)
+
+
+def clear_placement_cache():
+    global _placements_loaded_at
+    _placements_loaded_at = None
+
+
+def _placement_map():
+    global _placements, _placements_loaded_at
+    now = time.monotonic()
+    if _placements_loaded_at is None or now - _placements_loaded_at > placement_ttl():
+        from .models import DynamicModelPlacement
+        _placements = dict(
+            DynamicModelPlacement.objects.using('default').values_list('dynamic_model_id', 'db_alias')
+        )
+        _placements_loaded_at = now
+    return _placements
+
+
+def shard_for(dynamic_model):
+    """Return the alias storing the instances of ``dynamic_model`` (a model or its pk)."""
+    dynamic_model_id = getattr(dynamic_model, 'pk', dynamic_model)
+    return _placement_map().get(dynamic_model_id, default_shard())
+
+
+def instances_for(dynamic_model):
+    """Queryset of a DynamicModel's instances, bound to the shard that stores them."""
+    from .models import DynamicModelInstance
+    return DynamicModelInstance.objects.using(shard_for(dynamic_model)).filter(dynamic_model=dynamic_model)
+
+
+def get_instance_or_404(pk, **filters):
+    """Look an instance up by its (globally unique) id on whichever shard holds it."""
+    from .models import DynamicModelInstance
+    for alias in shard_aliases():
+        instance = DynamicModelInstance.objects.using(alias).filter(pk=pk, **filters).first()
+        if instance is not None:
+            return instance
+    raise Http404("No DynamicModelInstance matches the given query.")
+
+
+def get_file_or_404(pk, **filters):
+    """Look a DynamicFieldFile up by its (globally unique) id on whichever shard holds it."""
+    from .models import DynamicFieldFile
+    for alias in shard_aliases():
+        file = DynamicFieldFile.objects.using(alias).filter(pk=pk, **filters).first()
+        if file is not None:
+            return file
+    raise Http404("No DynamicFieldFile matches the given query.")
+
+
+def _shard_user(user):
+    # Shards only need a row for created_by foreign keys to point at (and a username to
+    # display); logins always read default, so credentials and personal details stay there
+    from django.contrib.auth.hashers import make_password
+    from django.contrib.auth.models import User
+
+    return User(
+        pk=user.pk, username=user.username, password=make_password(None),
+        is_active=False, date_joined=user.date_joined,
+    )
+
+
+def sync_catalog(dynamic_model, alias):
+    """Copy the catalog rows a shard needs for ``dynamic_model`` onto ``alias``."""
+    if alias == 'default':
+        return
+    from django.contrib.auth.models import User
+    from .models import DynamicModel, DynamicField, DynamicFieldChoice
+
+    model = DynamicModel.objects.using('default').get(pk=getattr(dynamic_model, 'pk', dynamic_model))
+    fields = list(DynamicField.objects.using('default').filter(dynamic_model=model))
+    choices = list(DynamicFieldChoice.objects.using('default').filter(dynamic_field__in=fields))
+    user_ids = {model.created_by_id} | {field.created_by_id for field in fields}
+    users = [_shard_user(user) for user in User.objects.using('default').filter(pk__in=user_ids)]
+
+    with transaction.atomic(using=alias):
+        for obj in [*users, model, *fields, *choices]:
+            obj.save_base(using=alias, raw=True)
+        DynamicField.objects.using(alias).filter(dynamic_model=model).exclude(
+            pk__in=[field.pk for field in fields]
+        ).delete()
+        DynamicFieldChoice.objects.using(alias).filter(dynamic_field__dynamic_model=model).exclude(
+            pk__in=[choice.pk for choice in choices]
+        ).delete()
+
+
+def _copy_rows(queryset, alias):
+    for obj in queryset:
+        obj.save_base(using=alias, raw=True, force_insert=True)
+
+
+def _lock_for_writes(queryset):
+    """Keep other writers off ``queryset``'s rows until the current transaction ends."""
+    connection = connections[queryset.db]
+    if connection.vendor == 'sqlite':
+        # SQLite ignores SELECT ... FOR UPDATE, and a transaction only takes the
+        # database's write lock at its first write, so make one that changes nothing
+        with connection.cursor() as cursor:
+            cursor.execute(f"UPDATE {connection.ops.quote_name(queryset.model._meta.db_table)} SET id = id WHERE 0")
+    else:
+        list(queryset.select_for_update().values_list('pk', flat=True))
+
+
+def _move_history(dynamic_model, source, target, batch_size):
+    """
+    Move the history versions and blobs of ``dynamic_model`` from ``source`` to
+    ``target``. Versions written on the source after the placement flipped start
+    a new chain there, so they are numbered on from each instance's last version
+    on the target.
+    """
+    from django.db.models import Max
+    from .models import InstanceBlob, InstanceVersion
+
+    versions = InstanceVersion.objects.using(source).filter(dynamic_model_id=dynamic_model.pk)
+    latest = dict(InstanceVersion.objects.using(target).filter(
+        dynamic_model_id=dynamic_model.pk, instance_id__in=set(versions.values_list('instance_id', flat=True)),
+    ).values('instance_id').annotate(latest=Max('version')).values_list('instance_id', 'latest'))
+    copies = []
+    for row in versions.order_by('instance_id', 'version').iterator():
+        offset = latest.get(row.instance_id, 0)
+        row.pk, row.version, row.base_version = None, row.version + offset, row.base_version + offset
+        copies.append(row)
+    InstanceVersion.objects.using(target).bulk_create(copies, batch_size=batch_size)
+    versions.delete()
+
+    # Blobs are addressed by content, so one the target already holds is the same value
+    blobs = InstanceBlob.objects.using(source).filter(dynamic_model_id=dynamic_model.pk)
+    copies = []
+    for row in blobs.iterator():
+        row.pk = None
+        copies.append(row)
+    InstanceBlob.objects.using(target).bulk_create(copies, batch_size=batch_size, ignore_conflicts=True)
+    blobs.delete()
+
+
+def move_dynamic_model(dynamic_model, target, batch_size=500, log=None):
+    """
+    Move every instance, file, blob and history row of ``dynamic_model`` onto ``target``.
+
+    Rows are copied in batches while the source keeps serving reads and writes.
+    A catch-up pass with the source locked for writes then re-copies rows touched
+    during the copy, flips the placement and removes the source rows. Processes
+    that cached the old placement keep writing to the source until their cache
+    expires, so once it has a second locked pass moves whatever they wrote.
+    Returns the number of instances moved.
+    """
+    from . import history
+    from .models import (
+        ChangeLogEntry, DynamicModelInstance, DynamicFieldFile, DynamicModelPlacement, InstanceBlob, InstanceVersion,
+    )
+    from .changelog import suppressed
+
+    source = shard_for(dynamic_model)
+    if target not in shard_aliases():
+        raise ValueError(f"Unknown shard '{target}'. Configured shards: {', '.join(shard_aliases())}")
+    if source == target:
+        return 0
+
+    sync_catalog(dynamic_model, target)
+    # Leftovers from an interrupted move would collide with the copied ids
+    with suppressed():
+        DynamicModelInstance.objects.using(target).filter(dynamic_model=dynamic_model).delete()
+    for history_model in (InstanceVersion, InstanceBlob):
+        history_model.objects.using(target).filter(dynamic_model_id=dynamic_model.pk).delete()
+
+    started = timezone.now()
+    source_instances = DynamicModelInstance.objects.using(source).filter(dynamic_model=dynamic_model)
+    source_files = DynamicFieldFile.objects.using(source).filter(instance__dynamic_model=dynamic_model)
+    target_instances = DynamicModelInstance.objects.using(target).filter(dynamic_model=dynamic_model)
+    target_files = DynamicFieldFile.objects.using(target).filter(instance__dynamic_model=dynamic_model)
+    last_pk = 0
+    while True:
+        batch = list(source_instances.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+        if not batch:
+            break
+        with transaction.atomic(using=target):
+            _copy_rows(batch, target)
+        last_pk = batch[-1].pk
+        if log:
+            log(f"Copied instances up to id {last_pk}")
+
+    # Moved rows are not new changes, so the deletes below stay out of the change log
+    with suppressed(), transaction.atomic(using=source), transaction.atomic(using=target):
+        _lock_for_writes(source_instances)
+        source_pks = set(source_instances.values_list('pk', flat=True))
+
+        # Catch up with writes that happened while the batches were being copied
+        changed = list(source_instances.filter(pk__lte=last_pk, updated_at__gte=started))
+        target_instances.filter(pk__in=[obj.pk for obj in changed]).delete()
+        target_instances.exclude(pk__in=source_pks).delete()
+        _copy_rows(changed, target)
+        _copy_rows(source_instances.filter(pk__gt=last_pk), target)
+
+        target_files.delete()
+        _copy_rows(source_files, target)
+        # History and the blobs it refers to outlive instances, so they move with the model as a whole
+        _move_history(dynamic_model, source, target, batch_size)
+
+        DynamicModelPlacement.objects.using('default').update_or_create(
+            dynamic_model_id=dynamic_model.pk, defaults={'db_alias': target}
+        )
+        clear_placement_cache()
+        flipped = timezone.now()
+
+        source_files.delete()
+        source_instances.delete()
+
+    if log:
+        log(f"Placement switched to '{target}'; waiting {placement_ttl()}s for cached placements to expire")
+    time.sleep(placement_ttl())
+
+    with suppressed(), transaction.atomic(using=source), transaction.atomic(using=target):
+        _lock_for_writes(source_instances)
+        # Anything left on the source was written through a stale placement since the flip
+        late = list(source_instances)
+        late_pks = {obj.pk for obj in late}
+        target_instances.filter(pk__in=late_pks).delete()
+        _copy_rows(late, target)
+        late_files = list(source_files)
+        target_files.filter(pk__in=[obj.pk for obj in late_files]).delete()
+        _copy_rows(late_files, target)
+
+        # Deleting an instance the source no longer had only reached the source's change log
+        late_deletes = ChangeLogEntry.objects.using(source).filter(
+            dynamic_model_id=dynamic_model.pk, object_type='instance', action='delete', created_at__gte=flipped,
+        ).values_list('object_id', flat=True)
+        for instance in target_instances.filter(pk__in=list(late_deletes)).exclude(pk__in=late_pks):
+            history.record_version(instance, target, deleted=True)
+            instance.delete(using=target)
+
+        _move_history(dynamic_model, source, target, batch_size)
+        source_files.delete()
+        source_instances.delete()
+
+    return len(source_pks | late_pks)
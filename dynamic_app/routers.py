@@ -0,0 +1,38 @@
+from .partitioning import shard_for
+
+PARTITIONED_MODELS = {'dynamic_app.DynamicModelInstance', 'dynamic_app.DynamicFieldFile', 'dynamic_app.InstanceBlob'}
+
+
+class DynamicModelRouter:
+    """
+    Routes DynamicModelInstance rows and the rows hanging off them to the shard of their DynamicModel.
+
+    Querysets carry no instance hint, so code reading instances should go through
+    ``partitioning.instances_for()``; saves and related lookups are routed here.
+    """
+
+    def _db_for(self, model, hints):
+        if model._meta.label not in PARTITIONED_MODELS:
+            return None
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        if instance._meta.label == 'dynamic_app.DynamicModel':
+            return shard_for(instance.pk)
+        dynamic_model_id = getattr(instance, 'dynamic_model_id', None)
+        if dynamic_model_id is None and 'instance' in instance._state.fields_cache:
+            # DynamicFieldFile with its owning instance already loaded
+            dynamic_model_id = instance.instance.dynamic_model_id
+        if dynamic_model_id is not None:
+            return shard_for(dynamic_model_id)
+        return instance._state.db
+
+    def db_for_read(self, model, **hints):
+        return self._db_for(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db_for(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Shards mirror the catalog rows they reference, so cross-alias relations are safe
+        return True
@@ -0,0 +1,328 @@
+"""
+Import and export of whole DynamicModel definitions.
+
+A schema looks like::
+
+    {"name": "Product",
+     "fields": [{"name": "size", "display_name": "Size", "field_type": "choice",
+                 "is_required": true, "choices": [{"value": "s", "display_name": "Small"}]}]}
+
+Applying a schema diffs it against the stored definition and writes only the
+difference, in one transaction, using bulk queries.
+
+Flags a field leaves out are off. That includes ``is_unique``, although
+DynamicField itself defaults it to on, so a schema only gets the constraints it
+spells out. Switching ``is_required`` or ``is_unique`` on is refused while
+existing instances would break the constraint.
+"""
+import json
+from types import SimpleNamespace
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from . import changelog, computed, constraints
+from .computed import computed_fields
+from .models import DynamicModel, DynamicField, DynamicFieldChoice
+from .partitioning import shard_for, sync_catalog
+
+try:
+    import yaml
+except ImportError:  # PyYAML is optional; JSON always works
+    yaml = None
+
+# Unlike DynamicField.is_unique, an omitted is_unique means off (see the module docstring)
+FIELD_DEFAULTS = {
+    'is_required': False,
+    'is_unique': False,
+    'is_readonly': False,
+    'persist_result': False,
+}
+FIELD_ATTRIBUTES = [
+    'display_name', 'field_type', 'is_required', 'is_unique', 'is_readonly', 'display_order',
+    'expression', 'persist_result',
+]
+CHOICE_ATTRIBUTES = ['display_name', 'order']
+
+
+def loads(text, format='json'):
+    if format == 'yaml':
+        if yaml is None:
+            raise ValidationError("YAML schemas need PyYAML installed (pip install pyyaml).")
+        try:
+            return yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise ValidationError(f"Invalid YAML: {e}")
+    try:
+        return json.loads(text)
+    except ValueError as e:
+        raise ValidationError(f"Invalid JSON: {e}")
+
+
+def dumps(schema, format='json'):
+    if format == 'yaml':
+        if yaml is None:
+            raise ValidationError("YAML schemas need PyYAML installed (pip install pyyaml).")
+        return yaml.safe_dump(schema, sort_keys=False)
+    return json.dumps(schema, indent=2)
+
+
+def export_schema(model):
+    fields = model.fields.prefetch_related('choices')
+    return {
+        'name': model.name,
+        'fields': [{
+            'name': field.name,
+            **{attribute: getattr(field, attribute) for attribute in FIELD_ATTRIBUTES},
+            **({'choices': [
+                {'value': choice.value, 'display_name': choice.display_name, 'order': choice.order}
+                for choice in field.choices.all()
+            ]} if field.field_type == 'choice' else {}),
+        } for field in fields],
+    }
+
+
+def _integer(value, label):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lstrip('-').isdigit():
+        return int(value)
+    raise ValidationError(f"{label} must be an integer, not {value!r}.")
+
+
+def _string(value, model, attribute, label):
+    """``value`` if it is a non-empty string that fits ``model.attribute``'s column."""
+    if not isinstance(value, str) or not value:
+        raise ValidationError(f"{label} must be a non-empty string, not {value!r}.")
+    max_length = model._meta.get_field(attribute).max_length
+    if max_length and len(value) > max_length:
+        raise ValidationError(f"{label} is longer than {max_length} characters.")
+    return value
+
+
+def _list(value, label):
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        raise ValidationError(f"{label} must be a list, not {type(value).__name__}.")
+    return value
+
+
+def normalize(schema):
+    """Validate a loaded schema and fill in defaults."""
+    if not isinstance(schema, dict) or not schema.get('name'):
+        raise ValidationError("A schema needs a 'name' and a list of 'fields'.")
+    model_name = _string(schema['name'], DynamicModel, 'name', "The schema's name")
+    field_types = dict(DynamicField.FIELD_TYPES)
+    fields = []
+    seen = set()
+    for position, field in enumerate(_list(schema.get('fields'), "'fields'")):
+        if not isinstance(field, dict) or not field.get('name'):
+            raise ValidationError(f"Field #{position + 1} needs a 'name'.")
+        name = _string(field['name'], DynamicField, 'name', f"Field #{position + 1}: name")
+        if name in seen:
+            raise ValidationError(f"Field '{name}' is defined twice.")
+        seen.add(name)
+        if field.get('field_type') not in field_types:
+            raise ValidationError(f"Field '{name}' has an unknown field_type '{field.get('field_type')}'.")
+        expression = field.get('expression') or ''
+        if not isinstance(expression, str):
+            raise ValidationError(f"Field '{name}': expression must be a string, not {expression!r}.")
+        normalized = {
+            'name': name,
+            'display_name': _string(
+                field.get('display_name') or name, DynamicField, 'display_name', f"Field '{name}': display_name"
+            ),
+            'field_type': field['field_type'],
+            'display_order': _integer(field.get('display_order', position), f"Field '{name}': display_order"),
+            'expression': expression,
+            **{attribute: bool(field.get(attribute, default)) for attribute, default in FIELD_DEFAULTS.items()},
+        }
+        if normalized['field_type'] == 'file' and normalized['is_unique']:
+            raise ValidationError(f"Field '{name}': file fields cannot be marked as unique.")
+        if 'choices' in field:
+            normalized['choices'] = []
+            for order, choice in enumerate(_list(field['choices'], f"Field '{name}': choices")):
+                label = f"Field '{name}': choice #{order + 1}"
+                if not isinstance(choice, dict) or choice.get('value') in (None, ''):
+                    raise ValidationError(f"{label} needs a 'value'.")
+                value = _string(choice['value'], DynamicFieldChoice, 'value', f"{label} value")
+                normalized['choices'].append({
+                    'value': value,
+                    'display_name': _string(
+                        choice.get('display_name') or value, DynamicFieldChoice, 'display_name', f"{label} display_name"
+                    ),
+                    'order': _integer(choice.get('order', order), f"{label} order"),
+                })
+        fields.append(normalized)
+
+    computed_fields([SimpleNamespace(**field) for field in fields])
+    return {'name': model_name, 'fields': fields}
+
+
+def _attribute_changes(obj, wanted, attributes):
+    return {
+        attribute: [getattr(obj, attribute), wanted[attribute]]
+        for attribute in attributes if getattr(obj, attribute) != wanted[attribute]
+    }
+
+
+def diff_schema(model, schema, prune=False):
+    """
+    What applying ``schema`` to ``model`` (``None`` for a new model) would change.
+    An empty dict means the schema is already in place.
+    """
+    diff = {}
+    existing = {field.name: field for field in model.fields.prefetch_related('choices')} if model else {}
+    if model is None:
+        diff['model'] = 'create'
+    elif model.name != schema['name']:
+        diff['model'] = {'name': [model.name, schema['name']]}
+
+    added, updated, choice_diffs = [], {}, {}
+    for wanted in schema['fields']:
+        field = existing.get(wanted['name'])
+        if field is None:
+            added.append(wanted['name'])
+        else:
+            changes = _attribute_changes(field, wanted, FIELD_ATTRIBUTES)
+            if changes:
+                updated[field.name] = changes
+        if 'choices' not in wanted:
+            continue
+        current = {choice.value: choice for choice in field.choices.all()} if field else {}
+        wanted_values = {choice['value'] for choice in wanted['choices']}
+        choice_diff = {
+            'add': [choice['value'] for choice in wanted['choices'] if choice['value'] not in current],
+            'update': {
+                choice['value']: _attribute_changes(current[choice['value']], choice, CHOICE_ATTRIBUTES)
+                for choice in wanted['choices']
+                if choice['value'] in current and _attribute_changes(current[choice['value']], choice, CHOICE_ATTRIBUTES)
+            },
+            'remove': [value for value in current if value not in wanted_values],
+        }
+        choice_diff = {key: value for key, value in choice_diff.items() if value}
+        if choice_diff:
+            choice_diffs[wanted['name']] = choice_diff
+
+    removed = [name for name in existing if name not in {field['name'] for field in schema['fields']}] if prune else []
+    field_diff = {key: value for key, value in (('add', added), ('update', updated), ('remove', removed)) if value}
+    if field_diff:
+        diff['fields'] = field_diff
+    if choice_diffs:
+        diff['choices'] = choice_diffs
+    return diff
+
+
+def _check_tightened(model, schema, diff):
+    """Raise ValidationError if switching on is_required/is_unique would break existing instances."""
+    field_types = {field['name']: field['field_type'] for field in schema['fields']}
+    problems = []
+    for name, changes in diff.get('fields', {}).get('update', {}).items():
+        required = changes.get('is_required') == [False, True]
+        unique = changes.get('is_unique') == [False, True]
+        if not (required or unique):
+            continue
+        report = constraints.check(model, name, field_types[name], required, unique)
+        if 'missing' in report:
+            problems.append(
+                f"Field '{name}' cannot be made required: {report['missing']['count']} instances have no value."
+            )
+        if 'duplicates' in report:
+            problems.append(
+                f"Field '{name}' cannot be made unique: "
+                f"{report['duplicates']['count']} instances repeat the value of an older one."
+            )
+    if problems:
+        raise ValidationError(' '.join(problems))
+
+
+def apply_schema(schema, user, model=None, prune=False, dry_run=False):
+    """
+    Create or update a DynamicModel from ``schema`` in a single transaction.
+
+    Returns ``(model, diff)``. With ``dry_run`` nothing is written and ``model``
+    is the existing model or ``None``. ``prune`` also removes fields that are
+    missing from the schema.
+    """
+    schema = normalize(schema)
+    if DynamicModel.objects.filter(name=schema['name']).exclude(pk=model.pk if model else None).exists():
+        raise ValidationError(f"A dynamic model named '{schema['name']}' already exists.")
+    diff = diff_schema(model, schema, prune=prune)
+    if model is not None:
+        _check_tightened(model, schema, diff)
+    if dry_run or not diff:
+        return model, diff
+
+    with transaction.atomic():
+        if model is None:
+            model = DynamicModel.objects.create(name=schema['name'], created_by=user)
+        elif model.name != schema['name']:
+            model.name = schema['name']
+            model.save()
+        existing = {field.name: field for field in model.fields.all()}
+        wanted_fields = {field['name']: field for field in schema['fields']}
+        field_diff = diff.get('fields', {})
+
+        new_fields = DynamicField.objects.bulk_create([
+            DynamicField(
+                dynamic_model=model,
+                created_by=user,
+                name=name,
+                **{attribute: wanted_fields[name][attribute] for attribute in FIELD_ATTRIBUTES},
+            )
+            for name in field_diff.get('add', [])
+        ])
+        changelog.record_bulk_create(new_fields, 'default')
+
+        changed_fields = []
+        for name in field_diff.get('update', {}):
+            field = existing[name]
+            previous = changelog.snapshot(field)
+            for attribute, (old, new) in field_diff['update'][name].items():
+                setattr(field, attribute, new)
+            changed_fields.append((field, previous))
+        DynamicField.objects.bulk_update([field for field, _ in changed_fields], FIELD_ATTRIBUTES)
+        for field, previous in changed_fields:
+            changelog.record(field, 'update', 'default', old=previous)
+
+        if field_diff.get('remove'):
+            DynamicField.objects.filter(dynamic_model=model, name__in=field_diff['remove']).delete()
+
+        fields = {**existing, **{field.name: field for field in new_fields}}
+        new_choices, changed_choices, removed_choices = [], [], []
+        for name, choice_diff in diff.get('choices', {}).items():
+            field = fields[name]
+            wanted_choices = {choice['value']: choice for choice in wanted_fields[name]['choices']}
+            new_choices += [
+                DynamicFieldChoice(dynamic_field=field, value=value, **{
+                    attribute: wanted_choices[value][attribute] for attribute in CHOICE_ATTRIBUTES
+                })
+                for value in choice_diff.get('add', [])
+            ]
+            if choice_diff.get('update') or choice_diff.get('remove'):
+                for choice in field.choices.all():
+                    if choice.value in choice_diff.get('update', {}):
+                        for attribute, (old, new) in choice_diff['update'][choice.value].items():
+                            setattr(choice, attribute, new)
+                        changed_choices.append(choice)
+                    elif choice.value in choice_diff.get('remove', []):
+                        removed_choices.append(choice.pk)
+        DynamicFieldChoice.objects.bulk_create(new_choices)
+        DynamicFieldChoice.objects.bulk_update(changed_choices, CHOICE_ATTRIBUTES)
+        DynamicFieldChoice.objects.filter(pk__in=removed_choices).delete()
+
+        # Bulk writes skip the post_save mirroring onto the model's shard
+        sync_catalog(model, shard_for(model))
+
+    # Stored computed values are stale once a formula is added or changed
+    updates = field_diff.get('update', {})
+    formula_changed = [
+        name for name in [*field_diff.get('add', []), *updates]
+        if 'computed' in (fields[name].field_type, updates.get(name, {}).get('field_type', [None])[0])
+        and (name not in updates or updates[name].keys() & {'field_type', 'expression', 'persist_result'})
+    ]
+    if formula_changed:
+        computed.recompute(model)
+
+    return model, diff
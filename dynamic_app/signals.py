@@ -0,0 +1,113 @@
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from . import changelog, computed, history, offload
+from .models import (
+    DynamicModel, DynamicField, DynamicFieldChoice, DynamicFieldFile, DynamicModelInstance, DynamicModelPlacement,
+)
+from .partitioning import shard_for, sync_catalog, clear_placement_cache
+
+
+def _catalog_model_id(sender, instance):
+    if sender is DynamicModel:
+        return instance.pk
+    if sender is DynamicField:
+        return instance.dynamic_model_id
+    return DynamicField.objects.filter(pk=instance.dynamic_field_id).values_list('dynamic_model_id', flat=True).first()
+
+
+@receiver(post_save, sender=DynamicModel)
+@receiver(post_save, sender=DynamicField)
+@receiver(post_save, sender=DynamicFieldChoice)
+def mirror_catalog(sender, instance, raw, using, **kwargs):
+    # Keep the shard's copy of the catalog in step with the authoritative rows on default
+    if raw or using != 'default':
+        return
+    dynamic_model_id = _catalog_model_id(sender, instance)
+    alias = shard_for(dynamic_model_id)
+    if alias != 'default':
+        sync_catalog(dynamic_model_id, alias)
+
+
+@receiver(pre_delete, sender=DynamicModel)
+@receiver(pre_delete, sender=DynamicField)
+@receiver(pre_delete, sender=DynamicFieldChoice)
+def remember_shard(sender, instance, using, **kwargs):
+    # The placement row may be cascaded away before post_delete runs
+    if using == 'default':
+        instance._shard_alias = shard_for(_catalog_model_id(sender, instance))
+
+
+@receiver(post_delete, sender=DynamicModel)
+@receiver(post_delete, sender=DynamicField)
+@receiver(post_delete, sender=DynamicFieldChoice)
+def delete_mirrored_catalog(sender, instance, using, **kwargs):
+    # Cascades on default never reach rows stored on another shard
+    alias = getattr(instance, '_shard_alias', 'default')
+    if using == 'default' and alias != 'default':
+        sender.objects.using(alias).filter(pk=instance.pk).delete()
+
+
+@receiver(post_save, sender=DynamicModelPlacement)
+@receiver(post_delete, sender=DynamicModelPlacement)
+def reset_placements(sender, **kwargs):
+    clear_placement_cache()
+
+
+def _is_logged(sender, using):
+    # Catalog rows are mirrored onto shards; only the authoritative copy is logged
+    return sender is not DynamicField or using == 'default'
+
+
+@receiver(pre_save, sender=DynamicModelInstance)
+@receiver(pre_save, sender=DynamicField)
+@receiver(pre_save, sender=DynamicFieldFile)
+def capture_previous_state(sender, instance, raw, using, **kwargs):
+    if raw or instance._state.adding or not _is_logged(sender, using):
+        return
+    previous = sender._base_manager.using(using).filter(pk=instance.pk).first()
+    instance._previous_state = changelog.snapshot(previous) if previous else {}
+
+
+@receiver(pre_save, sender=DynamicModelInstance)
+def prepare_instance_data(sender, instance, raw, using, **kwargs):
+    # Runs after capture_previous_state, so only fields whose inputs changed are recomputed
+    if raw:
+        return
+    fields = list(DynamicField.objects.filter(dynamic_model_id=instance.dynamic_model_id))
+    if instance._state.adding:
+        changed = None
+    else:
+        previous = getattr(instance, '_previous_state', {})
+        changed = {key for key in {*previous, *instance.data} if previous.get(key) != instance.data.get(key)}
+    computed.refresh_instances(fields, [instance], using, changed)
+    # Large values are swapped for references before the row is written; the blobs follow on post_save
+    instance._pending_blobs = offload.extract(instance, fields)
+
+
+@receiver(post_save, sender=DynamicModelInstance)
+def store_offloaded_values(sender, instance, raw, using, **kwargs):
+    if not raw:
+        offload.store(instance, instance.__dict__.pop('_pending_blobs', {}), using)
+
+
+@receiver(post_save, sender=DynamicModelInstance)
+@receiver(post_save, sender=DynamicField)
+@receiver(post_save, sender=DynamicFieldFile)
+def log_save(sender, instance, created, raw, using, **kwargs):
+    if raw or not _is_logged(sender, using):
+        return
+    previous = None if created else getattr(instance, '_previous_state', None)
+    changelog.record(instance, 'create' if created else 'update', using, old=previous)
+    if sender is DynamicModelInstance and not changelog.is_suppressed():
+        history.record_version(instance, using, previous=previous)
+
+
+@receiver(post_delete, sender=DynamicModelInstance)
+@receiver(post_delete, sender=DynamicField)
+@receiver(post_delete, sender=DynamicFieldFile)
+def log_delete(sender, instance, using, **kwargs):
+    if _is_logged(sender, using):
+        changelog.record(instance, 'delete', using)
+    if sender is DynamicModelInstance and not changelog.is_suppressed():
+        history.record_version(instance, using, deleted=True)
@@ -1,3 +1,801 @@
-from django.test import TestCase
+import hashlib
+import json
+import tempfile
+import time
+from datetime import timedelta
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections, router
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import changelog, computed, constraints, history, offload, partitioning, schema
+from .management.commands import loadtest
+from .models import *
+from .partitioning import clear_placement_cache, instances_for, move_dynamic_model, shard_for
+from .views import _byte_range
+
+SHARDS = {'default', 'shard1', 'shard2'}
+
+
+# No stale placements to wait out within a single test process
+@override_settings(DYNAMIC_MODEL_PLACEMENT_TTL=0)
+class ShardedTestCase(TestCase):
+    """Runs against every configured shard; each alias gets its own SQLite test database."""
+    databases = SHARDS
+
+    def setUp(self):
+        # Placements are cached per process and would outlive each test's rollback
+        clear_placement_cache()
+        PartitionSequence.clear_blocks()
+        self.user = User.objects.create_user('owner', email='owner@example.com', password='secret')
+
+    def make_model(self, name='Product', fields=(('title', 'char'),), shard=None):
+        model = DynamicModel.objects.create(name=name, created_by=self.user)
+        for order, (field_name, field_type) in enumerate(fields):
+            self.make_field(model, field_name, field_type, display_order=order)
+        if shard:
+            move_dynamic_model(model, shard)
+        return model
+
+    def make_field(self, model, name, field_type, **options):
+        options.setdefault('is_unique', False)
+        return DynamicField.objects.create(
+            dynamic_model=model, name=name, display_name=name.title(), field_type=field_type,
+            created_by=self.user, **options,
+        )
+
+    def make_instance(self, model, **data):
+        return instances_for(model).create(dynamic_model=model, created_by=self.user, data=data)
+
+
+class PartitioningTests(ShardedTestCase):
+
+    def test_models_start_on_the_default_shard(self):
+        model = self.make_model()
+        instance = self.make_instance(model, title='a')
+        self.assertEqual(shard_for(model), 'default')
+        self.assertEqual(instance._state.db, 'default')
+
+    def test_instances_are_stored_on_the_placed_shard(self):
+        model = self.make_model(shard='shard1')
+        instance = self.make_instance(model, title='a')
+
+        self.assertEqual(shard_for(model), 'shard1')
+        self.assertEqual(router.db_for_write(DynamicModelInstance, instance=instance), 'shard1')
+        self.assertTrue(DynamicModelInstance.objects.using('shard1').filter(pk=instance.pk).exists())
+        self.assertFalse(DynamicModelInstance.objects.using('default').filter(pk=instance.pk).exists())
+
+    def test_ids_are_unique_across_shards(self):
+        first = self.make_model('First')
+        second = self.make_model('Second', shard='shard2')
+        ids = [self.make_instance(model, title='x').pk for model in (first, second, first, second)]
+        self.assertEqual(ids, sorted(set(ids)))
+
+        block = PartitionSequence.allocate(DynamicModelInstance, 3)
+        self.assertEqual(len(block), 3)
+        self.assertGreater(block[0], ids[-1])
+        self.assertNotIn(PartitionSequence.next_id(DynamicModelInstance), block)
+
+    @override_settings(DYNAMIC_MODEL_ID_BLOCK_SIZE=10)
+    def test_ids_are_reserved_in_blocks(self):
+        model = self.make_model(shard='shard1')
+        self.make_instance(model, title='first')
+
+        with CaptureQueriesContext(connections['default']) as queries:
+            ids = [self.make_instance(model, title='x').pk for _ in range(9)]
+        self.assertFalse([query for query in queries if 'partitionsequence' in query['sql'].lower()])
+
+        with CaptureQueriesContext(connections['default']) as queries:
+            ids.append(self.make_instance(model, title='x').pk)
+        self.assertTrue([query for query in queries if 'partitionsequence' in query['sql'].lower()])
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_catalog_is_mirrored_with_choices(self):
+        model = self.make_model(fields=[('color', 'choice')])
+        field = model.fields.get()
+        DynamicFieldChoice.objects.create(dynamic_field=field, value='red', display_name='Red')
+        instance = self.make_instance(model, color='red')
+
+        move_dynamic_model(model, 'shard1')
+        DynamicFieldChoice.objects.create(dynamic_field=field, value='blue', display_name='Blue')
+
+        self.assertEqual(
+            set(DynamicFieldChoice.objects.using('shard1').values_list('value', flat=True)), {'red', 'blue'}
+        )
+        instances_for(model).get(pk=instance.pk).full_clean()
+
+    def test_shard_users_carry_no_credentials(self):
+        self.make_model(shard='shard1')
+        copy = User.objects.using('shard1').get(pk=self.user.pk)
+        self.assertEqual(copy.username, 'owner')
+        self.assertEqual(copy.email, '')
+        self.assertFalse(copy.has_usable_password())
+
+    def test_move_catches_up_with_writes_during_the_copy(self):
+        model = self.make_model()
+        instances = [self.make_instance(model, title=f'item {n}') for n in range(5)]
+        deleted_pk = instances[4].pk
+        added = []
+
+        def write_during_copy(message):
+            if added:
+                return
+            # The first batch is already on the target when these writes happen
+            instances[0].data['title'] = 'changed'
+            instances[0].save()
+            instances[4].delete()
+            added.append(self.make_instance(model, title='new'))
+
+        moved = move_dynamic_model(model, 'shard1', batch_size=2, log=write_during_copy)
+
+        self.assertEqual(moved, 5)
+        self.assertEqual(shard_for(model), 'shard1')
+        self.assertFalse(DynamicModelInstance.objects.using('default').filter(dynamic_model=model).exists())
+        titles = dict(instances_for(model).values_list('pk', 'data__title'))
+        self.assertEqual(titles, {
+            instances[0].pk: 'changed',
+            instances[1].pk: 'item 1',
+            instances[2].pk: 'item 2',
+            instances[3].pk: 'item 3',
+            added[0].pk: 'new',
+        })
+        self.assertTrue(InstanceVersion.objects.using('shard1').filter(instance_id=deleted_pk).exists())
+
+    def test_move_picks_up_writes_through_a_stale_placement(self):
+        model = self.make_model()
+        kept, updated, deleted = [self.make_instance(model, title=title) for title in ('kept', 'old', 'gone')]
+        deleted_pk = deleted.pk
+        late = []
+
+        def stale_writes(seconds):
+            # Another process still holding the old placement keeps writing to 'default'
+            with override_settings(DYNAMIC_MODEL_PLACEMENT_TTL=60):
+                partitioning._placements, partitioning._placements_loaded_at = {}, time.monotonic()
+                updated.data['title'] = 'new'
+                updated.save()
+                deleted.delete()
+                late.append(self.make_instance(model, title='late'))
+            clear_placement_cache()
+
+        with mock.patch('dynamic_app.partitioning.time.sleep', side_effect=stale_writes):
+            moved = move_dynamic_model(model, 'shard1')
+
+        self.assertEqual(moved, 4)
+        self.assertEqual(late[0]._state.db, 'default')
+        self.assertEqual(dict(instances_for(model).values_list('pk', 'data__title')), {
+            kept.pk: 'kept', updated.pk: 'new', late[0].pk: 'late',
+        })
+        for model_class in (DynamicModelInstance, InstanceVersion):
+            self.assertFalse(model_class.objects.using('default').filter(dynamic_model_id=model.pk).exists())
+        self.assertEqual(history.reconstruct(updated.pk), {'title': 'new'})
+        self.assertEqual(list(InstanceVersion.objects.using('shard1').filter(
+            instance_id=updated.pk).order_by('version').values_list('version', 'base_version')), [(1, 1), (2, 2)])
+        self.assertIsNone(history.reconstruct(deleted_pk))
+        self.assertEqual(history.reconstruct(late[0].pk), {'title': 'late'})
+
+    def test_move_to_an_unknown_shard_is_refused(self):
+        with self.assertRaises(ValueError):
+            move_dynamic_model(self.make_model(), 'nowhere')
+
+
+class ChangeLogTests(ShardedTestCase):
+
+    def test_feed_merges_shards_in_time_order(self):
+        first = self.make_model('First')
+        second = self.make_model('Second', shard='shard1')
+        model_ids = [first.pk, second.pk]
+
+        start = changelog.latest_cursor()
+        created = [self.make_instance(model, title=str(n)) for n, model in enumerate([first, second, first, second])]
+
+        page, cursor = changelog.changes_since(start, model_ids, limit=3)
+        rest, cursor = changelog.changes_since(cursor, model_ids, limit=3)
+
+        self.assertEqual([entry['object_id'] for entry in page + rest], [instance.pk for instance in created])
+        self.assertEqual([entry['shard'] for entry in page], ['default', 'shard1', 'default'])
+        self.assertEqual(changelog.changes_since(cursor, model_ids), ([], cursor))
+
+    def test_invalid_cursors_are_rejected(self):
+        for cursor in ('nowhere:1', 'default:x'):
+            with self.assertRaises(ValueError):
+                changelog.parse_cursor(cursor)
+
+    def test_merge_changes(self):
+        merged = changelog.merge_changes({'set': {'a': 1, 'b': 2}}, {'set': {'a': 3}, 'unset': ['b']})
+        self.assertEqual(merged, {'set': {'a': 3}, 'unset': ['b']})
+
+    def test_compaction_keeps_each_objects_final_state(self):
+        model = self.make_model()
+        kept = self.make_instance(model, title='a')
+        kept.data = {'title': 'b', 'extra': 'x'}
+        kept.save()
+        removed = self.make_instance(model, title='gone')
+        removed_pk = removed.pk
+        removed.delete()
+        entries = ChangeLogEntry.objects.filter(object_type='instance')
+        last_entry = entries.filter(object_id=kept.pk).last()
+
+        self.assertEqual(changelog.compact('default', timezone.now()), 2)
+
+        entry = entries.get(object_id=kept.pk)
+        self.assertEqual((entry.pk, entry.action), (last_entry.pk, 'create'))
+        self.assertEqual(entry.changes, {'set': {'title': 'b', 'extra': 'x'}})
+        self.assertEqual(entries.get(object_id=removed_pk).action, 'delete')
+
+    def test_cursors_behind_retention_expire(self):
+        old, quiet = self.make_model('Old', shard='shard1'), self.make_model('Quiet')
+        start = changelog.latest_cursor()
+        self.make_instance(old, title='a')
+        ChangeLogEntry.objects.using('shard1').update(created_at=timezone.now() - timedelta(days=60))
+
+        self.assertEqual(changelog.expire('shard1', timezone.now() - timedelta(days=30)), 1)
+
+        with self.assertRaises(changelog.CursorExpired):
+            changelog.changes_since(start, [old.pk, quiet.pk])
+        # Models that lost nothing to retention keep their cursors
+        self.assertEqual(changelog.changes_since(start, [quiet.pk])[0], [])
+        self.assertEqual(changelog.changes_since(changelog.latest_cursor(), [old.pk])[0], [])
+        call_command('compact_changelog', stdout=StringIO())
+        self.assertEqual(ChangeLogHorizon.objects.using('shard1').get(dynamic_model_id=old.pk).expired_through,
+                         changelog.parse_cursor(start)['shard1'] + 1)
+
+    async def test_expired_cursors_get_a_410(self):
+        model = await sync_to_async(self.make_model)(shard='shard2')
+        await self.async_client.aforce_login(self.user)
+        cursor = await sync_to_async(changelog.latest_cursor)()
+        await sync_to_async(self.make_instance)(model, title='a')
+        await sync_to_async(changelog.expire)('shard2', timezone.now() + timedelta(seconds=1))
+
+        response = await self.async_client.get('/changes/', {'since': cursor})
+        self.assertEqual(response.status_code, 410)
+        self.assertTrue(response.json()['expired'])
+        response = await self.async_client.get('/changes/stream/', headers={'Last-Event-ID': cursor})
+        self.assertEqual(response.status_code, 410)
+        response = await self.async_client.get('/changes/', {'since': 'latest'})
+        self.assertEqual(response.status_code, 200)
+
+    async def test_long_poll_returns_new_changes(self):
+        model = await sync_to_async(self.make_model)()
+        await self.async_client.aforce_login(self.user)
+        cursor = await sync_to_async(changelog.latest_cursor)()
+        await sync_to_async(self.make_instance)(model, title='a')
+
+        response = await self.async_client.get('/changes/', {'since': cursor, 'wait': 1})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([entry['action'] for entry in response.json()['changes']], ['create'])
+
+
+@override_settings(HISTORY_SNAPSHOT_INTERVAL=3)
+class HistoryTests(ShardedTestCase):
+
+    def make_versions(self, count):
+        model = self.make_model(fields=[('title', 'char'), ('n', 'int')])
+        instance = self.make_instance(model, title='v1', n='1')
+        states = [dict(instance.data)]
+        for version in range(2, count + 1):
+            instance.data = {'title': f'v{version}'} if version % 2 else {'title': 'even', 'n': str(version)}
+            instance.save()
+            states.append(dict(instance.data))
+        return model, instance, states
+
+    def test_every_version_replays_to_its_data(self):
+        model, instance, states = self.make_versions(7)
+        versions = InstanceVersion.objects.filter(instance_id=instance.pk)
+
+        self.assertEqual(list(versions.filter(is_snapshot=True).values_list('version', flat=True)), [1, 4, 7])
+        for version, data in enumerate(states, start=1):
+            self.assertEqual(history.reconstruct(instance.pk, version), data)
+
+    def test_deleted_instances_keep_their_history(self):
+        model, instance, states = self.make_versions(2)
+        pk = instance.pk
+        instance.delete()
+
+        self.assertIsNone(history.reconstruct(pk))
+        self.assertEqual(history.reconstruct(pk, 2), states[1])
+
+    def test_state_as_of(self):
+        model, instance, states = self.make_versions(2)
+        moment = timezone.now()
+        instance.data = {'title': 'later'}
+        instance.save()
+
+        self.assertEqual(history.state_as_of(model, moment), {instance.pk: states[1]})
+        self.assertEqual(history.state_as_of(model, timezone.now()), {instance.pk: {'title': 'later'}})
+
+    def test_prune_keeps_the_remaining_versions_readable(self):
+        model, instance, states = self.make_versions(6)
+        InstanceVersion.objects.update(created_at=timezone.now() - timedelta(days=30))
+
+        removed = history.prune('default', timezone.now() - timedelta(days=1), keep_versions=2)
+
+        self.assertEqual(removed, 4)
+        kept = InstanceVersion.objects.filter(instance_id=instance.pk)
+        self.assertEqual(list(kept.values_list('version', 'is_snapshot')), [(5, True), (6, False)])
+        self.assertEqual(history.reconstruct(instance.pk, 5), states[4])
+        self.assertEqual(history.reconstruct(instance.pk), states[5])
+
+
+class SchemaTests(ShardedTestCase):
+    definition = {
+        'name': 'Shirt',
+        'fields': [
+            {'name': 'title', 'field_type': 'char', 'is_required': True},
+            {'name': 'size', 'field_type': 'choice', 'choices': [{'value': 's'}, {'value': 'm'}]},
+        ],
+    }
+
+    def test_reapplying_a_schema_is_a_no_op(self):
+        model, diff = schema.apply_schema(self.definition, self.user)
+        self.assertEqual(diff['fields']['add'], ['title', 'size'])
+
+        with CaptureQueriesContext(connection) as queries:
+            again, diff = schema.apply_schema(schema.export_schema(model), self.user, model)
+        self.assertEqual((again, diff), (model, {}))
+        self.assertFalse([query for query in queries if not query['sql'].startswith('SELECT')])
+
+    def test_dry_run_writes_nothing(self):
+        model, diff = schema.apply_schema(self.definition, self.user, dry_run=True)
+        self.assertIsNone(model)
+        self.assertEqual(diff['model'], 'create')
+        self.assertFalse(DynamicModel.objects.filter(name='Shirt').exists())
+
+    def test_orders_must_be_integers(self):
+        for field in ({'name': 'a', 'field_type': 'char', 'display_order': 'abc'},
+                      {'name': 'a', 'field_type': 'choice', 'choices': [{'value': 'x', 'order': 1.5}]}):
+            with self.assertRaises(ValidationError):
+                schema.apply_schema({'name': 'Bad', 'fields': [field]}, self.user, dry_run=True)
+
+    def test_malformed_schemas_are_rejected(self):
+        for definition in (
+            {'name': 'X', 'fields': 5},
+            {'name': ['X']},
+            {'name': 'X' * 101},
+            {'name': 'X', 'fields': [{'name': 7, 'field_type': 'char'}]},
+            {'name': 'X', 'fields': [{'name': 'a', 'display_name': {'en': 'A'}, 'field_type': 'char'}]},
+            {'name': 'X', 'fields': [{'name': 'a', 'field_type': 'computed', 'expression': 1}]},
+            {'name': 'X', 'fields': [{'name': 'a', 'field_type': 'choice', 'choices': 5}]},
+            {'name': 'X', 'fields': [{'name': 'a', 'field_type': 'choice', 'choices': [{'value': 1}]}]},
+        ):
+            with self.assertRaises(ValidationError, msg=definition):
+                schema.apply_schema(definition, self.user, dry_run=True)
+
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('schema_import'), '{"name": "X", "fields": 5}', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(DynamicModel.objects.filter(name='X').exists())
+
+    def test_tightening_is_refused_while_data_conflicts(self):
+        model, _ = schema.apply_schema({'name': 'Tag', 'fields': [{'name': 'code', 'field_type': 'char'}]}, self.user)
+        self.make_instance(model, code='x')
+        self.make_instance(model, code='x')
+
+        unique = {'name': 'Tag', 'fields': [{'name': 'code', 'field_type': 'char', 'is_unique': True}]}
+        with self.assertRaises(ValidationError):
+            schema.apply_schema(unique, self.user, model, dry_run=True)
+        self.assertFalse(model.fields.get().is_unique)
+
+
+class ComputedFieldTests(ShardedTestCase):
+
+    def fields(self, **expressions):
+        plain = [SimpleNamespace(name='price', field_type='decimal', expression='', persist_result=False),
+                 SimpleNamespace(name='qty', field_type='int', expression='', persist_result=False),
+                 SimpleNamespace(name='name', field_type='char', expression='', persist_result=False)]
+        return plain + [
+            SimpleNamespace(name=name, field_type='computed', expression=expression, persist_result=True)
+            for name, expression in expressions.items()
+        ]
+
+    def test_expressions_evaluate_column_wise(self):
+        rows = [{'price': '2.50', 'qty': '4', 'name': 'ab'}, {'price': '1', 'qty': '', 'name': None}]
+        fields = self.fields(total='price * qty', label='concat(upper(name), "-", qty)', big='total > 5')
+
+        self.assertEqual(computed.evaluate(fields, rows), [
+            {'total': '10.00', 'label': 'AB-4', 'big': True},
+            {'total': None, 'label': '-', 'big': False},
+        ])
+
+    def test_bad_rows_give_none(self):
+        rows = [{'price': '1', 'qty': '0'}, {'price': 'abc', 'qty': '2'}]
+        self.assertEqual(computed.evaluate(self.fields(ratio='price / qty'), rows), [{'ratio': None}, {'ratio': None}])
+
+    def test_unsafe_or_unknown_expressions_are_rejected(self):
+        for expression in ('__import__("os")', 'name.upper()', 'eval("1")', 'missing + 1', '[1, 2]'):
+            with self.assertRaises(ValidationError):
+                computed.computed_fields(self.fields(bad=expression))
+
+    def test_cycles_are_rejected(self):
+        with self.assertRaises(ValidationError):
+            computed.computed_fields(self.fields(a='b + 1', b='a + 1'))
+
+    def test_power_results_are_capped(self):
+        rows = [{}]
+        self.assertEqual(computed.evaluate(self.fields(p='2 ** 10'), rows), [{'p': 1024}])
+        self.assertEqual(computed.evaluate(self.fields(p='(((9 ** 100) ** 100) ** 100) ** 100'), rows), [{'p': None}])
+
+    def test_persisted_values_see_offloaded_text(self):
+        model = self.make_model(fields=[('notes', 'text'), ('qty', 'int')])
+        self.make_field(model, 'total', 'computed', expression='len(notes) + qty', persist_result=True)
+        instance = self.make_instance(model, notes='n' * 5000, qty='1')
+        instance.data['qty'] = '2'
+        instance.save()
+
+        instance.refresh_from_db()
+        self.assertTrue(offload.is_ref(instance.data['notes']))
+        self.assertEqual(instance.data['total'], 5002)
+
+
+    def make_totals(self):
+        model = self.make_model(fields=[('qty', 'int')])
+        self.make_field(model, 'total', 'computed', expression='qty * 2', persist_result=True)
+        self.make_field(model, 'label', 'computed', expression='concat("x", total)')
+        return model, model.fields.get(name='qty')
+
+    def test_fields_read_by_formulas_cannot_be_renamed_or_deleted(self):
+        model, qty = self.make_totals()
+
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('field_update', args=[qty.pk]), {
+            'name': 'amount', 'display_name': 'Amount', 'field_type': 'int', 'display_order': 0,
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Computed field 'total' would stop working", response.context['form'].errors['name'][0])
+        qty.refresh_from_db()
+        self.assertEqual(qty.name, 'qty')
+
+        qty.field_type = 'decimal'
+        qty.full_clean()
+        with self.assertRaises(ValidationError):
+            qty.delete()
+        self.assertTrue(model.fields.filter(name='qty').exists())
+
+    def test_broken_formulas_evaluate_to_none(self):
+        model, qty = self.make_totals()
+        instance = self.make_instance(model, qty='2')
+        self.assertEqual(instance.data['total'], 4)
+        # Renamed behind the formulas' back, e.g. by a direct update
+        DynamicField.objects.filter(pk=qty.pk).update(name='amount')
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('instance_list', args=[model.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['instances'][0].data['label'], None)
+
+        instance.data['amount'] = '3'
+        instance.save()
+        self.assertIsNone(instance.data['total'])
+
+        # Each broken formula can be repaired on its own
+        total = model.fields.get(name='total')
+        total.expression = 'amount * 2'
+        total.full_clean()
+        total.save()
+        computed.recompute(model)
+        instance.refresh_from_db()
+        self.assertEqual(instance.data['total'], 6)
+
+class ByteRangeTests(SimpleTestCase):
+
+    def test_satisfiable_ranges(self):
+        self.assertEqual(_byte_range('bytes=0-9', 100), (0, 9))
+        self.assertEqual(_byte_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(_byte_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(_byte_range('bytes=-500', 100), (0, 99))
+        self.assertEqual(_byte_range('bytes=50-500', 100), (50, 99))
+        self.assertEqual(_byte_range('Bytes = 0-0', 100), (0, 0))
+
+    def test_unsatisfiable_ranges_raise(self):
+        for header, size in (('bytes=100-', 100), ('bytes=150-200', 100), ('bytes=-0', 100), ('bytes=-5', 0), ('bytes=0-', 0)):
+            with self.assertRaises(ValueError):
+                _byte_range(header, size)
+
+    def test_ignored_headers_serve_the_whole_file(self):
+        for header in ('bytes=0-9,20-29', 'items=0-9', 'bytes=abc', 'bytes=-', 'bytes=9-0', 'bytes=0-9x', ''):
+            self.assertIsNone(_byte_range(header, 100), header)
+
+
+class FileDownloadTests(ShardedTestCase):
+    CONTENT = b'%PDF-1.4\n' + bytes(range(256)) * 4
+
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        model = self.make_model(fields=[('doc', 'file')], shard='shard1')
+        self.file = DynamicFieldFile.objects.using('shard1').create(
+            instance=self.make_instance(model), field=model.fields.get(),
+            file=SimpleUploadedFile('report.pdf', self.CONTENT),
+        )
+        self.url = reverse('file_download', args=[self.file.pk])
+        self.etag = f'"{hashlib.sha256(self.CONTENT).hexdigest()}"'
+        self.client.force_login(self.user)
+
+    def test_owner_downloads_the_whole_file(self):
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENT)
+        self.assertEqual(response['ETag'], self.etag)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        self.assertIn('attachment; filename="report.pdf"', response['Content-Disposition'])
+
+    def test_other_users_get_a_404(self):
+        self.client.force_login(User.objects.create_user('other', password='secret'))
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_missing_content_hash_is_filled_in(self):
+        DynamicFieldFile.objects.using('shard1').filter(pk=self.file.pk).update(content_hash='')
+
+        self.assertEqual(self.client.get(self.url)['ETag'], self.etag)
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.content_hash, self.etag.strip('"'))
+
+    def test_matching_etag_gets_a_304(self):
+        response = self.client.get(self.url, headers={'If-None-Match': self.etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], self.etag)
+
+    def test_ranges(self):
+        size = len(self.CONTENT)
+        response = self.client.get(self.url, headers={'Range': 'bytes=0-9', 'If-Range': self.etag})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 0-9/{size}')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENT[:10])
+
+        response = self.client.get(self.url, headers={'Range': 'bytes=-5'})
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENT[-5:])
+
+        # The client's copy is outdated, so it gets the whole current file instead of a part
+        response = self.client.get(self.url, headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.CONTENT)
+
+        response = self.client.get(self.url, headers={'Range': f'bytes={size}-'})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{size}')
+
+    def test_sendfile_headers(self):
+        with override_settings(DYNAMIC_FILES_SENDFILE='x-accel-redirect', DYNAMIC_FILES_SENDFILE_PREFIX='/protected/'):
+            response = self.client.get(self.url, headers={'Range': 'bytes=0-9'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected/{self.file.file.name}')
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], self.etag)
+
+        with override_settings(DYNAMIC_FILES_SENDFILE='x-sendfile'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], self.file.file.path)
+
+        with override_settings(DYNAMIC_FILES_SENDFILE='apache'), self.assertRaises(ImproperlyConfigured):
+            self.client.get(self.url)
+
+class ConstraintTests(ShardedTestCase):
+
+    def test_check_reports_missing_and_duplicate_values(self):
+        model = self.make_model(fields=[('title', 'char'), ('sku', 'char')], shard='shard1')
+        rows = [self.make_instance(model, title=title, sku='x') for title in ('a', 'a', 'a', 'b', 'b', 'c', '')]
+        untitled = self.make_instance(model, sku='y')
+
+        report = constraints.check(model, 'title', 'char', required=True, unique=True)
+
+        self.assertEqual(report['missing'], {'count': 2, 'instances': [rows[6].pk, untitled.pk]})
+        self.assertEqual(report['duplicates']['groups'], 2)
+        self.assertEqual(report['duplicates']['count'], 3)
+        self.assertEqual(report['duplicates']['examples'], [
+            {'value': 'a', 'count': 3, 'instances': [row.pk for row in rows[:3]]},
+            {'value': 'b', 'count': 2, 'instances': [row.pk for row in rows[3:5]]},
+        ])
+        self.assertEqual(constraints.check(model, 'sku', 'char', required=True), {})
+        self.assertEqual(constraints.check(model, 'title', 'computed', required=True), {})
+
+    def test_offloaded_values_group_by_content(self):
+        model = self.make_model(fields=[('notes', 'text')])
+        for notes in ('n' * 5000, 'n' * 5000, 'm' * 5000):
+            self.make_instance(model, notes=notes)
+
+        report = constraints.check(model, 'notes', 'text', unique=True)
+
+        self.assertEqual((report['duplicates']['groups'], report['duplicates']['count']), (1, 1))
+
+    def test_fill_missing_refreshes_computed_fields_and_history(self):
+        model = self.make_model(fields=[('title', 'char')], shard='shard2')
+        self.make_field(model, 'shout', 'computed', expression='upper(title)', persist_result=True)
+        blank = self.make_instance(model, title='')
+        kept = self.make_instance(model, title='kept')
+
+        self.assertEqual(constraints.fill_missing(model, 'title', 'filled', batch_size=1), 1)
+
+        blank.refresh_from_db()
+        self.assertEqual(blank.data, {'title': 'filled', 'shout': 'FILLED'})
+        self.assertEqual(history.reconstruct(blank.pk), blank.data)
+        self.assertEqual(InstanceVersion.objects.using('shard2').filter(instance_id=blank.pk).count(), 2)
+        self.assertEqual(InstanceVersion.objects.using('shard2').filter(instance_id=kept.pk).count(), 1)
+        self.assertEqual(constraints.check(model, 'title', 'char', required=True), {})
+
+    def test_drop_duplicates_keeps_the_oldest(self):
+        model = self.make_model(shard='shard1')
+        rows = [self.make_instance(model, title=title) for title in ('a', 'b', 'a', '', '', 'a', 'b')]
+        # Another process's id block can give an older instance the higher id
+        instances_for(model).filter(pk=rows[2].pk).update(created_at=rows[0].created_at - timedelta(seconds=1))
+
+        self.assertEqual(constraints.drop_duplicates(model, 'title'), 3)
+
+        remaining = list(instances_for(model).order_by('pk').values_list('pk', flat=True))
+        self.assertEqual(remaining, [rows[1].pk, rows[2].pk, rows[3].pk, rows[4].pk])
+        self.assertEqual(constraints.check(model, 'title', 'char', unique=True), {})
+
+
+    def tighten(self, field, **extra):
+        self.client.force_login(self.user)
+        return self.client.post(reverse('field_update', args=[field.pk]), {
+            'name': field.name, 'display_name': field.display_name, 'field_type': field.field_type,
+            'is_required': 'on', 'is_unique': 'on', 'display_order': 0, **extra,
+        })
+
+    def test_refused_fixes_are_rolled_back(self):
+        model = self.make_model(shard='shard1')
+        for title in ('a', 'a', ''):
+            self.make_instance(model, title=title)
+        field = model.fields.get()
+
+        response = self.tighten(field, drop_duplicates='on')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['conflicts']['missing']['count'], 1)
+        self.assertEqual(sorted(instances_for(model).values_list('data__title', flat=True)), ['', 'a', 'a'])
+        field.refresh_from_db()
+        self.assertFalse(field.is_required or field.is_unique)
+
+    def test_fixes_that_clear_every_conflict_are_kept(self):
+        model = self.make_model(shard='shard1')
+        for title in ('a', 'a', ''):
+            self.make_instance(model, title=title)
+        field = model.fields.get()
+
+        response = self.tighten(field, drop_duplicates='on', fill_value='b')
+
+        self.assertRedirects(response, reverse('model_detail', args=[model.pk]), fetch_redirect_response=False)
+        self.assertEqual(sorted(instances_for(model).values_list('data__title', flat=True)), ['a', 'b'])
+        field.refresh_from_db()
+        self.assertTrue(field.is_required and field.is_unique)
+
+    def test_fill_values_are_validated(self):
+        model = self.make_model(fields=[('color', 'choice'), ('qty', 'int'), ('doc', 'file'), ('on', 'bool')])
+        DynamicFieldChoice.objects.create(dynamic_field=model.fields.get(name='color'), value='red', display_name='Red')
+        self.make_instance(model)
+
+        for name, value in (('color', 'blue'), ('qty', 'many'), ('doc', 'a.pdf'), ('on', 'yes')):
+            with self.assertRaises(ValidationError):
+                constraints.fill_missing(model, name, value)
+        self.assertEqual(constraints.fill_missing(model, 'color', 'red'), 1)
+
+        field = model.fields.get(name='qty')
+        response = self.tighten(field, fill_value='many')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['conflicts']['fill_error'], ["'many' is not a valid integer."])
+
+    def test_long_fill_values_are_offloaded(self):
+        model = self.make_model(fields=[('notes', 'text')], shard='shard2')
+        instance = self.make_instance(model)
+
+        constraints.fill_missing(model, 'notes', 'n' * 5000)
+
+        instance.refresh_from_db()
+        self.assertTrue(offload.is_ref(instance.data['notes']))
+        self.assertEqual(instance.get_value('notes'), 'n' * 5000)
+
+class OffloadTests(ShardedTestCase):
+    LONG, OTHER = 'a' * 5000, 'b' * 5000
+
+    def make_notes(self, notes):
+        model = self.make_model(fields=[('title', 'char'), ('notes', 'text')], shard='shard1')
+        return self.make_instance(model, title='t' * 5000, notes=notes)
+
+    def blobs(self, instance_id):
+        return InstanceBlob.objects.using('shard1').filter(instance_id=instance_id)
+
+    def test_large_text_values_are_offloaded_once(self):
+        instance = self.make_notes(self.LONG)
+        instance.refresh_from_db()
+
+        self.assertTrue(offload.is_ref(instance.data['notes']))
+        self.assertEqual(instance.data['notes']['preview'], self.LONG[:64])
+        self.assertEqual(instance.data['title'], 't' * 5000)
+        self.assertEqual(instance.get_value('notes'), self.LONG)
+
+        [inflated] = offload.inflate([instance])
+        inflated.save()
+        self.assertEqual(self.blobs(instance.pk).count(), 1)
+
+    def test_history_stays_readable_after_delete(self):
+        instance = self.make_notes(self.LONG)
+        instance_id = instance.pk
+        instance.data['notes'] = self.OTHER
+        instance.save()
+        instance.delete()
+
+        for version, notes in ((1, self.LONG), (2, self.OTHER)):
+            state = {instance_id: history.reconstruct(instance_id, version)}
+            self.assertEqual(offload.resolve(state, 'shard1')[instance_id]['notes'], notes)
+        self.assertIsNone(history.reconstruct(instance_id))
+
+    def test_prune_collects_unreferenced_blobs(self):
+        instance = self.make_notes(self.LONG)
+        instance.data['notes'] = self.OTHER
+        instance.save()
+        self.assertEqual(self.blobs(instance.pk).count(), 2)
+
+        history.prune('shard1', timezone.now() + timedelta(days=1), keep_versions=1)
+
+        self.assertEqual(list(self.blobs(instance.pk).values_list('field_name', flat=True)), ['notes'])
+        self.assertEqual(instance.get_value('notes'), self.OTHER)
+        self.assertEqual(offload.resolve({instance.pk: history.reconstruct(instance.pk)}, 'shard1'),
+                         {instance.pk: {'title': 't' * 5000, 'notes': self.OTHER}})
+
+        instance_id = instance.pk
+        instance.delete()
+        history.prune('shard1', timezone.now() + timedelta(days=1), keep_versions=1)
+        self.assertFalse(self.blobs(instance_id).exists())
+
+
+class LoadTestReportTests(SimpleTestCase):
+
+    def test_percentile(self):
+        values = [n / 1000 for n in range(1, 101)]
+        self.assertEqual(loadtest.percentile(values, 50), 50.0)
+        self.assertEqual(loadtest.percentile(values, 99), 99.0)
+        self.assertEqual(loadtest.percentile(values, 100), 100.0)
+        self.assertEqual(loadtest.percentile([0.0123], 90), 12.3)
+        self.assertIsNone(loadtest.percentile([], 50))
+
+    def test_saturation(self):
+        def level(concurrency, throughput):
+            return {'concurrency': concurrency, 'throughput_rps': throughput, 'latency': {'p99_ms': 1.0}}
+
+        saturation = loadtest.Command().saturation([level(16, 105), level(1, 50), level(4, 100)])
+        self.assertEqual([point['concurrency'] for point in saturation['curve']], [1, 4, 16])
+        self.assertEqual(saturation['saturated_at_concurrency'], 4)
+        self.assertIsNone(loadtest.Command().saturation([level(1, 50), level(4, 100)])['saturated_at_concurrency'])
+
+
+# Requests run on the ASGI handler's own thread, which only sees committed rows
+@override_settings(DYNAMIC_MODEL_PLACEMENT_TTL=0)
+class LoadTestCommandTests(TransactionTestCase):
+    databases = SHARDS
+
+    def test_smoke_run_reports_and_cleans_up(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        out = StringIO()
+        with override_settings(MEDIA_ROOT=media.name):
+            call_command(
+                'loadtest', duration=0.2, concurrency='1,2', users=2, seed_instances=2, stdout=out, stderr=StringIO(),
+            )
+
+        report = json.loads(out.getvalue())
+        self.assertEqual(set(report), {'database', 'duration_per_level_s', 'users', 'mix', 'levels', 'saturation'})
+        self.assertEqual([level['concurrency'] for level in report['levels']], [1, 2])
+        for level in report['levels']:
+            self.assertGreater(level['requests'], 0)
+            self.assertEqual(set(level['latency']), {'p50_ms', 'p90_ms', 'p99_ms', 'max_ms'})
+        self.assertEqual(len(report['saturation']['curve']), 2)
+
+        for alias in SHARDS:
+            self.assertFalse(User.objects.using(alias).filter(username__startswith='loadtest_').exists())
+            for model in (DynamicModel, DynamicModelInstance, ChangeLogEntry, InstanceVersion, InstanceBlob):
+                self.assertFalse(model.objects.using(alias).exists(), f'{model.__name__} rows left on {alias}')
@@ -2,10 +2,23 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.http import JsonResponse
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.utils.http import content_disposition_header, quote_etag
 from .models import *
 from .forms import *
+from .partitioning import instances_for, get_file_or_404, get_instance_or_404, shard_aliases, shard_for
+from . import changelog, computed, constraints, history, offload, schema
+import asyncio
 import json
+import mimetypes
+import time
+from urllib.parse import quote
 # hello 
 from django.http import JsonResponse
 
@@ -34,7 +47,7 @@ def model_create(request):
 def model_detail(request, pk):
     model = get_object_or_404(DynamicModel, pk=pk, created_by=request.user)
     fields = model.fields.all()
-    instances = DynamicModelInstance.objects.filter(dynamic_model=model)
+    instances = instances_for(model)
     
     return render(request, 'dynamic_models/model_detail.html', {
         'model': model,
@@ -44,21 +57,28 @@ def model_detail(request, pk):
 
 
     
+def _recompute(request, model):
+    scanned, updated = computed.recompute(model)
+    if scanned:
+        messages.info(request, f'Recomputed stored values: {updated} of {scanned} instances changed.')
+
+
 @login_required
 def field_create(request, model_pk):
     model = get_object_or_404(DynamicModel, pk=model_pk, created_by=request.user)
 
     if request.method == 'POST':
         form = DynamicFieldForm(request.POST, request.FILES, initial={
-            'dynamic_model': model,
             'created_by': request.user
-        })
+        }, dynamic_model=model)
         if form.is_valid():
-            form.save()
+            field = form.save()
             messages.success(request, 'Field added successfully!')
+            if field.field_type == 'computed' and field.persist_result:
+                _recompute(request, model)
             return redirect('model_detail', pk=model_pk)
     else:
-        form = DynamicFieldForm()
+        form = DynamicFieldForm(dynamic_model=model)
 
     return render(request, 'dynamic_models/field_form.html', {
         'form': form,
@@ -92,22 +112,94 @@ def add_field_choices(request, field_id):
 
     
 
+def _flag(request, name):
+    return request.GET.get(name, '').lower() in ('1', 'true', 'yes')
+
+
+def _apply_schema_request(request, model):
+    fmt = request.GET.get('format') or ('yaml' if 'yaml' in request.content_type else 'json')
+    dry_run = _flag(request, 'dry_run')
+    try:
+        definition = schema.loads(request.body.decode(), fmt)
+        if model is None and isinstance(definition, dict):
+            # Importing a schema whose model already exists updates that model
+            model = DynamicModel.objects.filter(name=definition.get('name'), created_by=request.user).first()
+        model, diff = schema.apply_schema(definition, request.user, model, prune=_flag(request, 'prune'), dry_run=dry_run)
+    except (ValidationError, UnicodeDecodeError) as e:
+        return JsonResponse({'error': e.messages[0] if isinstance(e, ValidationError) else str(e)}, status=400)
+
+    return JsonResponse({
+        'model': model.pk if model else None,
+        'dry_run': dry_run,
+        'changed': bool(diff),
+        'diff': diff,
+    })
+
+
+@login_required
+def model_schema(request, model_pk):
+    """GET exports the model's schema; POST applies a schema to it (``?dry_run=1`` previews the diff)."""
+    model = get_object_or_404(DynamicModel, pk=model_pk, created_by=request.user)
+    if request.method == 'POST':
+        return _apply_schema_request(request, model)
+
+    fmt = request.GET.get('format', 'json')
+    try:
+        body = schema.dumps(schema.export_schema(model), fmt)
+    except ValidationError as e:
+        return JsonResponse({'error': e.messages[0]}, status=400)
+    return HttpResponse(body, content_type='application/yaml' if fmt == 'yaml' else 'application/json')
+
+
+@login_required
+def schema_import(request):
+    """Create a model from a posted schema, or update the user's model of the same name."""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST a JSON or YAML schema.'}, status=405)
+    return _apply_schema_request(request, None)
+
+
 @login_required
 def field_update(request, pk):
     field = get_object_or_404(DynamicField, pk=pk, dynamic_model__created_by=request.user)
+    conflicts = {}
     
     if request.method == 'POST':
+        # The form updates ``field`` in place, so keep what existing data was written under
+        name, was_required, was_unique = field.name, field.is_required, field.is_unique
+        formula = (field.field_type, field.expression, field.persist_result)
         form = DynamicFieldForm(request.POST, instance=field)
         if form.is_valid():
-            form.save()
-            messages.success(request, 'Field updated successfully!')
-            return redirect('model_detail', pk=field.dynamic_model.pk)
+            model = field.dynamic_model
+            required = field.is_required and not was_required
+            unique = field.is_unique and not was_unique
+            if required or unique:
+                # Optional fix-ups offered alongside a previous conflict report
+                try:
+                    conflicts = constraints.apply_fixes(
+                        model, name, field.field_type, required, unique,
+                        fill_value=request.POST.get('fill_value'), drop=bool(request.POST.get('drop_duplicates')),
+                    )
+                except ValidationError as e:
+                    conflicts = constraints.check(model, name, field.field_type, required, unique)
+                    conflicts['fill_error'] = e.messages
+            if not conflicts:
+                form.save()
+                messages.success(request, 'Field updated successfully!')
+                # Persisted values may read this field's formula, directly or through other computed fields
+                if 'computed' in (formula[0], field.field_type) and formula != (
+                    field.field_type, field.expression, field.persist_result
+                ):
+                    _recompute(request, model)
+                return redirect('model_detail', pk=field.dynamic_model.pk)
+            messages.error(request, 'Existing instances conflict with the new constraints.')
     else:
         form = DynamicFieldForm(instance=field)
     
     return render(request, 'dynamic_models/field_form.html', {
         'form': form,
         'field': field,
+        'conflicts': conflicts,
         'model': field.dynamic_model
     })
 
@@ -126,7 +218,10 @@ def instance_create(request, model_pk):
         files_to_save = []
 
         for field in fields:
-            if field.field_type == 'file':
+            if field.field_type == 'computed':
+                # Filled in from the other fields when the instance is saved
+                continue
+            elif field.field_type == 'file':
                 uploaded_file = request.FILES.get(field.name)
                 if field.is_required and not uploaded_file:
                     errors[field.name] = 'This file is required.'
@@ -151,7 +246,7 @@ def instance_create(request, model_pk):
 
         if not errors:
             # Create the instance
-            instance = DynamicModelInstance.objects.create(
+            instance = instances_for(model).create(
                 dynamic_model=model,
                 created_by=request.user,
                 data=data
@@ -159,7 +254,7 @@ def instance_create(request, model_pk):
 
             # Save files linked to the instance
             for field, uploaded_file in files_to_save:
-                DynamicFieldFile.objects.create(
+                DynamicFieldFile.objects.using(instance._state.db).create(
                     instance=instance,
                     field=field,
                     file=uploaded_file,
@@ -182,7 +277,7 @@ def instance_create(request, model_pk):
 
 @login_required
 def upload_file(request, instance_id, field_id):
-    instance = get_object_or_404(DynamicModelInstance, pk=instance_id, created_by=request.user)
+    instance = get_instance_or_404(instance_id, created_by=request.user)
     field = get_object_or_404(DynamicField, pk=field_id)
 
     if request.method == 'POST':
@@ -193,19 +288,122 @@ def upload_file(request, instance_id, field_id):
             file_instance.field = field
             file_instance.save()
             messages.success(request, 'File uploaded successfully!')
-            return redirect('instance_detail', instance_id=instance.id)
+            return redirect('instance_list', model_pk=instance.dynamic_model_id)
     else:
         form = DynamicFieldFileForm()
 
     return render(request, 'dynamic_models/upload_file.html', {'form': form, 'instance': instance, 'field': field})    
     
     
+def _byte_range(header, size):
+    """
+    ``(start, end)`` for a single ``bytes=`` range, or ``None`` when the header
+    should be ignored and the whole file served (malformed or multiple ranges).
+    Raises ValueError when the range cannot be satisfied.
+    """
+    units, _, spec = header.partition('=')
+    start, dash, end = spec.strip().partition('-')
+    if units.strip().lower() != 'bytes' or not dash or not (start + end).isdigit():
+        return None
+    if not start:
+        if int(end) == 0 or size == 0:
+            raise ValueError
+        return max(0, size - int(end)), size - 1
+    start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start >= size:
+        raise ValueError
+    return (start, end) if start <= end else None
+
+
+def _read_range(file, start, length, chunk_size=64 * 1024):
+    with file.open('rb'):
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _file_response(request, file_obj, size, etag):
+    filename = os.path.basename(file_obj.file.name)
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    sendfile = settings.DYNAMIC_FILES_SENDFILE
+    if sendfile:
+        # The web server does the transfer, Range requests included
+        response = HttpResponse(content_type=content_type)
+        response['Content-Disposition'] = content_disposition_header(True, filename)
+        if sendfile == 'x-accel-redirect':
+            prefix = settings.DYNAMIC_FILES_SENDFILE_PREFIX.rstrip('/')
+            response['X-Accel-Redirect'] = f"{prefix}/{quote(file_obj.file.name)}"
+        elif sendfile == 'x-sendfile':
+            response['X-Sendfile'] = file_obj.file.path
+        else:
+            raise ImproperlyConfigured("DYNAMIC_FILES_SENDFILE must be None, 'x-accel-redirect' or 'x-sendfile'.")
+        return response
+
+    byte_range = None
+    # A Range only applies to the version the client has when it sends If-Range
+    if request.headers.get('Range') and request.headers.get('If-Range', etag) == etag:
+        try:
+            byte_range = _byte_range(request.headers['Range'], size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+    if byte_range is None:
+        # FileResponse hands the open file to the server's wsgi.file_wrapper, i.e. sendfile() where supported
+        return FileResponse(
+            file_obj.file.storage.open(file_obj.file.name, 'rb'),
+            as_attachment=True, filename=filename, content_type=content_type,
+        )
+
+    start, end = byte_range
+    response = StreamingHttpResponse(
+        _read_range(file_obj.file, start, end - start + 1), status=206, content_type=content_type
+    )
+    response['Content-Length'] = end - start + 1
+    response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    return response
+
+
+@login_required
+def file_download(request, file_id):
+    """
+    Download an uploaded file. The ETag is the content hash, so If-None-Match
+    gets a 304, and a single byte Range gets a 206 with just that part.
+    """
+    file_obj = get_file_or_404(file_id, instance__created_by=request.user)
+    try:
+        size = file_obj.file.size
+    except (OSError, ValueError):
+        raise Http404("The file is missing from storage.")
+    if not file_obj.content_hash:
+        # Files uploaded before content hashes were stored get theirs on first download
+        file_obj.content_hash = file_obj.compute_content_hash()
+        DynamicFieldFile.objects.using(file_obj._state.db).filter(pk=file_obj.pk).update(
+            content_hash=file_obj.content_hash
+        )
+
+    etag = quote_etag(file_obj.content_hash)
+    response = get_conditional_response(request, etag=etag) or _file_response(request, file_obj, size, etag)
+    response['ETag'] = etag
+    response['Accept-Ranges'] = 'bytes'
+    # Per-user content: browsers may keep it but must revalidate with the ETag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
 @login_required
 def instance_list(request, model_pk):
     model = get_object_or_404(DynamicModel, pk=model_pk, created_by=request.user)
-    instances = DynamicModelInstance.objects.filter(dynamic_model=model)
-
     fields = model.fields.all()  # Get all the fields of the dynamic model
+    # Non-persisted computed fields are evaluated once for the whole list, not per cell
+    instances = computed.with_display_values(fields, offload.inflate(instances_for(model)))
+
     return render(request, 'dynamic_models/instance_list.html', {
         'model': model,
         'instances': instances,
@@ -222,14 +420,24 @@ def dynamic_instance_search(request):
     fields = []
     
     if query:
-        # Fetch matching DynamicModelInstance objects
-        results = DynamicModelInstance.objects.filter(
-            data__icontains=query
-        ).select_related('dynamic_model', 'created_by')
+        # Fetch matching DynamicModelInstance objects from every shard; offloaded values only match on their preview
+        for alias in shard_aliases():
+            results.extend(DynamicModelInstance.objects.using(alias).filter(
+                data__icontains=query
+            ).select_related('dynamic_model', 'created_by'))
         
         # Get fields from the first instance's dynamic_model
-        if results.exists():
-            fields = results.first().dynamic_model.fields.all()
+        if results:
+            fields = results[0].dynamic_model.fields.all()
+            results = offload.inflate(results)
+            # Results can come from several models; each batch gets its own model's computed fields
+            fields_by_model, results_by_model = {}, {}
+            for instance in results:
+                results_by_model.setdefault(instance.dynamic_model_id, []).append(instance)
+            for model_field in DynamicField.objects.filter(dynamic_model_id__in=results_by_model):
+                fields_by_model.setdefault(model_field.dynamic_model_id, []).append(model_field)
+            for model_id, instances in results_by_model.items():
+                computed.with_display_values(fields_by_model.get(model_id, []), instances)
 
     context = {
         'query': query,
@@ -237,4 +445,138 @@ def dynamic_instance_search(request):
         'fields': fields,
     }
     return render(request, 'dynamic_models/dynamic_instance_search.html', context)
-    
\ No newline at end of file
+
+
+def _change_feed_models(request, user):
+    model_ids = list(DynamicModel.objects.filter(created_by=user).values_list('pk', flat=True))
+    if request.GET.get('model'):
+        model_ids = [pk for pk in model_ids if str(pk) == request.GET['model']]
+    return model_ids
+
+
+def _change_feed_cursor(cursor):
+    return changelog.latest_cursor() if cursor == 'latest' else cursor
+
+
+# The feeds wait between polls, so they are async views: under ASGI a waiting
+# client holds neither a worker thread nor, for the stream, buffered output.
+changes_since = sync_to_async(changelog.changes_since)
+
+
+@login_required
+async def change_feed(request):
+    """Changes after the ``since`` cursor; ``wait`` seconds turns the call into a long poll."""
+    model_ids = await sync_to_async(_change_feed_models)(request, await request.auser())
+    try:
+        cursor = await sync_to_async(_change_feed_cursor)(request.GET.get('since', ''))
+        limit = max(1, min(int(request.GET.get('limit', 100)), 1000))
+        deadline = time.monotonic() + min(float(request.GET.get('wait', 0)), 30)
+        entries, cursor = await changes_since(cursor, model_ids, limit)
+        while not entries and time.monotonic() < deadline:
+            await asyncio.sleep(settings.CHANGELOG_POLL_INTERVAL)
+            entries, cursor = await changes_since(cursor, model_ids, limit)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except changelog.CursorExpired as e:
+        return JsonResponse({'error': str(e), 'expired': True}, status=410)
+
+    return JsonResponse({'changes': entries, 'cursor': cursor})
+
+
+@login_required
+async def change_stream(request):
+    """Server-sent events feed of changes; resumes from ``Last-Event-ID`` on reconnect."""
+    model_ids = await sync_to_async(_change_feed_models)(request, await request.auser())
+    cursor = await sync_to_async(_change_feed_cursor)(
+        request.headers.get('Last-Event-ID') or request.GET.get('since', '')
+    )
+    try:
+        positions = changelog.parse_cursor(cursor)
+        # Refuse an expired cursor up front, while a status code can still say so
+        entries, cursor = await changes_since(cursor, model_ids)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except changelog.CursorExpired as e:
+        return JsonResponse({'error': str(e), 'expired': True}, status=410)
+
+    async def events():
+        nonlocal cursor, entries
+        deadline = time.monotonic() + settings.CHANGELOG_STREAM_SECONDS
+        yield 'retry: 2000\n\n'
+        while time.monotonic() < deadline:
+            if entries is None:
+                try:
+                    entries, cursor = await changes_since(cursor, model_ids)
+                except changelog.CursorExpired as e:
+                    # Retention overtook the stream; a reconnect with this Last-Event-ID gets the 410
+                    yield f"event: expired\ndata: {json.dumps({'error': str(e)})}\n\n"
+                    return
+            for entry in entries:
+                positions[entry['shard']] = entry['id']
+                yield (f"id: {changelog.format_cursor(positions)}\n"
+                       f"event: change\ndata: {json.dumps(entry)}\n\n")
+            if not entries:
+                yield ': keep-alive\n\n'
+                await asyncio.sleep(settings.CHANGELOG_POLL_INTERVAL)
+            entries = None
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@login_required
+def instance_history(request, instance_id):
+    """Versions of an instance, or its data at ``?version=N``."""
+    alias = history.history_alias(instance_id)
+    versions = InstanceVersion.objects.using(alias).filter(instance_id=instance_id) if alias else []
+    first = versions.first() if alias else None
+    if first is None or not DynamicModel.objects.filter(pk=first.dynamic_model_id, created_by=request.user).exists():
+        raise Http404("No history for this instance.")
+
+    if request.GET.get('version'):
+        version = request.GET['version']
+        if not version.isdigit() or not versions.filter(version=version).exists():
+            return JsonResponse({'error': f"Unknown version '{version}'."}, status=400)
+        data = history.reconstruct(instance_id, int(version), alias)
+        return JsonResponse({
+            'instance': instance_id,
+            'version': int(version),
+            'data': offload.resolve({instance_id: data}, alias)[instance_id],
+        })
+
+    return JsonResponse({
+        'instance': instance_id,
+        'versions': [{
+            'version': v.version,
+            'created_at': v.created_at.isoformat(),
+            'snapshot': v.is_snapshot,
+            'deleted': v.is_deleted,
+            'changes': None if v.is_snapshot else v.payload,
+        } for v in versions],
+    })
+
+
+@login_required
+def model_history(request, model_pk):
+    """State of every instance of a model as of ``?as_of=<ISO datetime>``."""
+    model = get_object_or_404(DynamicModel, pk=model_pk, created_by=request.user)
+    as_of = parse_datetime(request.GET.get('as_of', ''))
+    if as_of is None:
+        return JsonResponse({'error': "Pass as_of as an ISO 8601 datetime."}, status=400)
+    if timezone.is_naive(as_of):
+        as_of = timezone.make_aware(as_of)
+
+    state = offload.resolve(history.state_as_of(model, as_of), shard_for(model))
+    return JsonResponse({
+        'model': model.pk,
+        'as_of': as_of.isoformat(),
+        'instances': [{'id': instance_id, 'data': data} for instance_id, data in state.items()],
+    })
+
+
+@login_required
+def model_history_stats(request, model_pk):
+    model = get_object_or_404(DynamicModel, pk=model_pk, created_by=request.user)
+    return JsonResponse({'model': model.pk, **history.stats(model)})